@@ -0,0 +1,166 @@
+#!/usr/bin/env python3
+"""
+Micro-benchmark for titler.process_first_heading(): checks that it gives the same titles, and leaves
+the same heading markup, as the original implementation (which serialised the heading once per question
+it asked of it, and parsed every titlecased span afresh) on thousands of headings in the styles Standard Ebooks uses, then compares the time taken,
+the number of serialisations and the memory allocated by each.
+
+Run from the repository root: python3 benchmarks/headings.py
+"""
+import itertools
+import os
+import sys
+import time
+import tracemalloc
+import bs4
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import titler  # noqa: E402
+from url_safe import CORPUS  # noqa: E402
+
+ROMANS = ["I", "IV", "IX", "XIV", "XL", "LXXXVIII", "CXX"]
+
+# heading layouts, filled in with a numeral, a title and a subtitle
+LAYOUTS = [
+	'<h2 epub:type="title z3998:roman">{roman}</h2>',
+	'<h2 epub:type="title">{title}</h2>',
+	'<h2 epub:type="title">Book <span epub:type="z3998:roman">{roman}</span></h2>',
+	'<h3 epub:type="title">\n\t<span epub:type="z3998:roman">{roman}</span>\n\t<span epub:type="subtitle">{subtitle}</span>\n</h3>',
+	'<h3 epub:type="title">\n\t<span>{title}</span>\n\t<span epub:type="subtitle">{subtitle}</span>\n</h3>',
+	'<h2 epub:type="title">\n\t<span epub:type="z3998:roman">{roman}</span>\n\t<span epub:type="subtitle">The <i>{subtitle}</i> &amp; Others</span>\n</h2>',
+	'<h4 epub:type="title">\n\t<span>{title}</span>\n</h4>',
+	'<h2 epub:type="title">\n\t<span epub:type="z3998:roman">{roman}</span>\n\t<span epub:type="subtitle">{subtitle}</span>\n\t<a href="endnotes.xhtml#note-1" id="noteref-1" epub:type="noteref">1</a>\n</h2>',
+	'<h3 epub:type="title">\n\t<span epub:type="z3998:roman">{roman}</span>\n\t<br/>\n\t<span epub:type="subtitle">{subtitle}</span>\n</h3>',
+	'<h3 epub:type="title">\n\t<span epub:type="z3998:roman">{roman}</span>:\n\t<span epub:type="subtitle">{subtitle}</span>\n</h3>',
+	'<h2 epub:type="title"></h2>'
+]
+
+
+def headings() -> list:
+	"""
+	:return: markup for each heading in the corpus, each within the sections that usually enclose it
+	"""
+	titles = [title.strip() for title in CORPUS if title.strip() and "<" not in title and "&" not in title]
+	markup = []
+	for layout, (index, title), shift in itertools.product(LAYOUTS, enumerate(titles), range(1, 5)):
+		heading = layout.format(roman=ROMANS[(index + shift) % len(ROMANS)], title=title, subtitle=titles[(index * 7 + shift) % len(titles)].lower())
+		markup.append('<section id="part-1" epub:type="part"><section id="chapter-1" epub:type="chapter">' + heading + '</section></section>')
+	return markup
+
+
+def legacy_process_first_heading(heading: bs4.BeautifulSoup) -> titler.TitleInfo:
+	"""
+	process_first_heading() and update_span() as they were before heading analysis became a single pass, for comparison
+	"""
+	def extract_contents_as_string(tag):
+		accumulator = ""
+		for content in tag.contents:
+			accumulator += str(content)
+		return accumulator
+
+	def update_span(span, textstr):
+		sup = bs4.BeautifulSoup(textstr, "html.parser")
+		span.clear()
+		span.append(sup)
+
+	title_info = titler.TitleInfo()
+	title_info.division, title_info.prefix = titler.get_book_division(heading)
+	temp_title = extract_contents_as_string(heading)
+	match = titler.regex.search(r'(Book|Part|Division|Volume) <span epub:type="z3998:roman">(.*?)</span>', temp_title, titler.regex.IGNORECASE)
+	if match:
+		title_info.title_no_embeds = match.group(1) + " " + str(titler.roman.fromRoman(match.group(2)))
+		title_info.title = titler.titlecase(temp_title)
+		title_info.section_id = titler.url_safe(title_info.title_no_embeds)
+		return title_info
+	line_count = str(heading).count("\n") + 1
+	if line_count == 1:
+		epub_type = heading.get("epub:type") or ""
+		if epub_type:
+			if "z3998:roman" in epub_type:
+				title_info.roman = heading.get_text()
+				title_info.number = titler.roman.fromRoman(title_info.roman)
+				title_info.section_id = title_info.generate_id()
+				return title_info
+			else:
+				title_info.title = titler.titlecase(extract_contents_as_string(heading))
+				title_info.title_no_embeds = titler.titlecase(heading.get_text())
+				return title_info
+	spans = heading.find_all("span", recursive=False)
+	if spans:
+		for span in spans:
+			epub_type = span.get("epub:type") or ""
+			if "z3998:roman" in epub_type:
+				title_info.roman = span.get_text()
+				title_info.number = titler.roman.fromRoman(title_info.roman)
+			elif "subtitle" in epub_type:
+				title_info.subtitle_no_embeds = titler.titlecase(span.get_text())
+				title_info.subtitle = titler.titlecase(extract_contents_as_string(span))
+				update_span(span, title_info.subtitle)
+			else:
+				title_info.title = titler.titlecase(extract_contents_as_string(span))
+				title_info.title_no_embeds = titler.titlecase(span.get_text())
+				update_span(span, title_info.title)
+		return title_info
+
+
+def parse(markup: list) -> list:
+	"""
+	:return: the first heading tag of each piece of markup, freshly parsed
+	"""
+	return [bs4.BeautifulSoup(text, "html.parser").find(titler.HEADING_TAGS) for text in markup]
+
+
+def measure(function, markup: list) -> tuple:
+	"""
+	Run a heading analysis over freshly parsed headings.
+	:return: seconds taken, number of Tag.decode() calls (serialisations), and the mean of the peak bytes
+		allocated while analysing each heading
+	"""
+	parsed = parse(markup)
+	decode = bs4.element.Tag.decode
+	calls = [0]
+
+	def counting_decode(*args, **kwargs):
+		calls[0] += 1
+		return decode(*args, **kwargs)
+
+	bs4.element.Tag.decode = counting_decode
+	try:
+		start = time.perf_counter()
+		for heading in parsed:
+			function(heading)
+		seconds = time.perf_counter() - start
+	finally:
+		bs4.element.Tag.decode = decode
+	parsed = parse(markup)
+	peaks = 0
+	tracemalloc.start()
+	for heading in parsed:
+		before = tracemalloc.get_traced_memory()[0]
+		tracemalloc.reset_peak()
+		function(heading)
+		peaks += tracemalloc.get_traced_memory()[1] - before
+	tracemalloc.stop()
+	return seconds, calls[0], peaks / len(markup)
+
+
+def main():
+	markup = headings()
+	mismatches = 0
+	for text, legacy_heading, heading in zip(markup, parse(markup), parse(markup)):
+		legacy_info = legacy_process_first_heading(legacy_heading)
+		info = titler.process_first_heading(heading)
+		if legacy_info.to_dict() != info.to_dict() or str(legacy_heading) != str(heading):
+			mismatches += 1
+			print("MISMATCH: " + text)
+	print("Checked " + str(len(markup)) + " headings, " + str(mismatches) + " mismatches")
+
+	# titlecasing is cached by now, so both are timed on the heading analysis itself
+	for name, function in (("legacy", legacy_process_first_heading), ("single pass", titler.process_first_heading)):
+		seconds, serialisations, peak = min(measure(function, markup) for repeat in range(3))
+		print("{:>12}: {:7.2f} µs, {:5.2f} serialisations, {:7.0f} bytes peak allocation per heading".format(name, seconds / len(markup) * 1e6, serialisations / len(markup), peak))
+	sys.exit(1 if mismatches else 0)
+
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,81 @@
+#!/usr/bin/env python3
+"""
+Equivalence check for titler's --parser engines: processes synthetic Standard Ebooks chapters, with
+paragraphs holding character references and markup that XML itself doesn't allow, with html.parser and
+with lxml, in every --format mode and with --fast, and checks that both engines give the same output
+text, section id and title information. Also reports the time each engine took.
+
+Run from the repository root: python3 benchmarks/parsers.py
+"""
+import contextlib
+import io
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import titler  # noqa: E402
+from synthetic import PARAGRAPH, generate_project  # noqa: E402
+
+# paragraphs swapped in for the usual one; those after the first two aren't well-formed XML,
+# so lxml can't parse them and titler must fall back to html.parser rather than lose text
+PARAGRAPHS = [
+	PARAGRAPH,
+	"<p>It was a dark&#160;and stormy night&#x2014;the rain fell &amp; fell &lt;in torrents&gt;.</p>",
+	"<p>It was&nbsp;a dark and stormy night&mdash;the rain fell in torrents.</p>",
+	"<p>It was a dark<br> and stormy night.</p>",
+	"<p>It was a <b>dark and stormy night.</p>"
+]
+
+
+def run(spine: list, textpath: str, parser: str) -> tuple:
+	"""
+	Process each file in every way the engine is used.
+	:return: list of (file name, way, output text, section id, title information), seconds taken,
+		and the number of files lxml fell back on html.parser for
+	"""
+	results = []
+	messages = io.StringIO()
+	start = time.perf_counter()
+	with contextlib.redirect_stdout(messages):
+		for file_name in spine:
+			file_path = os.path.join(textpath, file_name)
+			for format_mode in titler.FORMAT_MODES:
+				out_xhtml, new_id, title_info = titler.process_file(file_path, parser, format_mode)
+				results.append((file_name, format_mode, out_xhtml, new_id, title_info and title_info.to_dict()))
+			out_xhtml, new_id, title_info = titler.process_file_head(file_path, parser)
+			results.append((file_name, "fast", out_xhtml, new_id, title_info and title_info.to_dict()))
+	return results, time.perf_counter() - start, messages.getvalue().count("so html.parser is used")
+
+
+def main():
+	workdir = tempfile.mkdtemp(prefix="titler-parsers-")
+	mismatches = 0
+	try:
+		spine = generate_project(workdir, 8, 5, 2, "mixed", per_division=4)
+		textpath = os.path.join(workdir, "src", "epub", "text")
+		for number, paragraph in enumerate(PARAGRAPHS):
+			if number:
+				for file_name in spine:
+					file_path = os.path.join(textpath, file_name)
+					titler.puthtml(titler.gethtml(file_path).replace(PARAGRAPHS[number - 1], paragraph), file_path)
+			timings = {}
+			outputs = {}
+			for parser in ("html.parser", "lxml"):
+				outputs[parser], seconds, fallbacks = run(spine, textpath, parser)
+				timings[parser] = "{}: {:.1f} ms".format(parser, seconds * 1000) + (" (" + str(fallbacks) + " fallbacks)" if fallbacks else "")
+			for expected, result in zip(outputs["html.parser"], outputs["lxml"]):
+				if expected != result:
+					mismatches += 1
+					print("MISMATCH: " + result[0] + " (" + result[1] + ") with " + paragraph)
+			print("Paragraph " + str(number + 1) + ": " + ", ".join(timings.values()))
+	finally:
+		shutil.rmtree(workdir, ignore_errors=True)
+	print(str(mismatches) + " mismatches")
+	sys.exit(1 if mismatches else 0)
+
+
+if __name__ == "__main__":
+	main()
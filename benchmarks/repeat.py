@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+"""
+Repeat-run check for titler: on synthetic Standard Ebooks projects whose parts have ids without numbers
+(eg part-the-first, which titler rewrites on the part's title page but not on the wrappers of its chapters),
+with a plain heading laid out across lines and with an empty heading, runs titler in each output mode,
+then checks that a second run changes nothing and that --check passes. Also reports the time each run took.
+
+Run from the repository root: python3 benchmarks/repeat.py
+"""
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from synthetic import generate_project  # noqa: E402
+
+TITLER = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "titler.py")
+
+# ways of running titler, each checked separately
+MODES = [[], ["--fast"], ["--format", "changed"], ["--format", "splice"], ["--parser", "lxml"], ["--jobs", "2"]]
+
+# ids without numbers, for the parts that generate_project() numbers
+PART_IDS = ["part-the-first", "part-the-second", "part-the-third"]
+
+
+def make_project(rootpath: str):
+	"""
+	Write a project of chapters in parts with unnumbered ids, where one chapter has a plain title
+	across several lines and another an empty heading
+	"""
+	spine = generate_project(rootpath, 6, 2, 2, "roman", per_division=2)
+	textpath = os.path.join(rootpath, "src", "epub", "text")
+	for file_name in spine:
+		file_path = os.path.join(textpath, file_name)
+		with open(file_path, "r", encoding="utf-8") as fileobject:
+			text = fileobject.read()
+		for number, part_id in enumerate(PART_IDS, 1):
+			text = text.replace('id="part-' + str(number) + '"', 'id="' + part_id + '"')
+		if file_name == "chapter-2.xhtml":
+			text = text.replace('<h3 epub:type="title z3998:roman">II</h3>', '<h3 epub:type="title">\n\t\t\t\t\tthe lost letter\n\t\t\t\t</h3>')
+		elif file_name == "chapter-5.xhtml":
+			text = text.replace('<h3 epub:type="title z3998:roman">V</h3>', '<h3 epub:type="title"></h3>')
+		with open(file_path, "w", encoding="utf-8") as fileobject:
+			fileobject.write(text)
+
+
+def snapshot(rootpath: str) -> dict:
+	"""
+	:return: dict mapping each file name in the project's text directory to its text
+	"""
+	textpath = os.path.join(rootpath, "src", "epub", "text")
+	texts = {}
+	for file_name in sorted(os.listdir(textpath)):
+		with open(os.path.join(textpath, file_name), "r", encoding="utf-8") as fileobject:
+			texts[file_name] = fileobject.read()
+	return texts
+
+
+def run_titler(arguments: list) -> (int, float):
+	"""
+	:return: titler's exit status and the seconds it took
+	"""
+	start = time.perf_counter()
+	status = subprocess.run([sys.executable, "-W", "ignore", TITLER] + arguments, stdout=subprocess.DEVNULL).returncode
+	return status, time.perf_counter() - start
+
+
+def main():
+	workdir = tempfile.mkdtemp(prefix="titler-repeat-")
+	failures = 0
+	try:
+		source = os.path.join(workdir, "source")
+		make_project(source)
+		for mode in MODES:
+			project = os.path.join(workdir, "run")
+			shutil.rmtree(project, ignore_errors=True)
+			shutil.copytree(source, project)
+			problems = []
+			status, first = run_titler(mode + [project])
+			written = snapshot(project)
+			if status:
+				problems.append("first run exited with status " + str(status))
+			status, second = run_titler(mode + [project])
+			changed = [file_name for file_name, text in snapshot(project).items() if written.get(file_name) != text]
+			if status or changed:
+				problems.append("second run exited with status " + str(status) + " and changed " + (", ".join(changed) or "nothing"))
+			status, check = run_titler(["--check", project])
+			if status:
+				problems.append("--check after the first run failed")
+			name = " ".join(mode) or "default"
+			print("{:>18}: {:6.0f} ms first run, {:6.0f} ms second run, {:6.0f} ms check".format(name, first * 1000, second * 1000, check * 1000))
+			for problem in problems:
+				failures += 1
+				print("FAILED: " + name + ": " + problem)
+	finally:
+		shutil.rmtree(workdir, ignore_errors=True)
+	print(str(failures) + " failures")
+	sys.exit(1 if failures else 0)
+
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,81 @@
+#!/usr/bin/env python3
+"""
+Startup-time check for titler: measures `import titler` with `python -X importtime`,
+shows which imports the time goes to, and fails if it exceeds IMPORT_BUDGET_MS or if
+any of the heavy dependencies are imported before they are needed.
+
+Run from the repository root: python3 benchmarks/startup.py
+"""
+import os
+import subprocess
+import sys
+import time
+
+# budget for the cumulative time of `import titler`, in milliseconds
+IMPORT_BUDGET_MS = 40
+
+# modules which should only be imported once there is work to do
+HEAVY_MODULES = ["bs4", "lxml", "regex", "roman", "se", "multiprocessing"]
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def import_times() -> list:
+	"""
+	Import titler in a fresh interpreter with -X importtime.
+	:return: list of (self microseconds, cumulative microseconds, nesting level, module name)
+		for titler and everything it imported, titler last
+	"""
+	process = subprocess.run([sys.executable, "-X", "importtime", "-c", "import titler"], cwd=ROOT, capture_output=True, text=True, check=True)
+	entries = []
+	for line in process.stderr.splitlines():
+		if not line.startswith("import time:") or "self [us]" in line:
+			continue
+		self_time, cumulative, name = line[len("import time:"):].split("|")
+		level = (len(name) - len(name.lstrip())) // 2
+		entries.append((int(self_time), int(cumulative), level, name.strip()))
+		if name.strip() == "titler":
+			break
+	# keep only titler and the imports nested under it
+	start = len(entries) - 1
+	while start > 0 and entries[start - 1][2] > 0:
+		start -= 1
+	return entries[start:]
+
+
+def loaded_heavy_modules() -> list:
+	"""
+	:return: the heavy modules which `import titler` actually loads (rather than just registers lazily)
+	"""
+	# type() rather than .__class__, which would make a lazy module load
+	code = "import sys, titler; print(' '.join(name for name in " + repr(HEAVY_MODULES) + " if name in sys.modules and type(sys.modules[name]).__name__ != '_LazyModule'))"
+	process = subprocess.run([sys.executable, "-c", code], cwd=ROOT, capture_output=True, text=True, check=True)
+	return process.stdout.split()
+
+
+def main():
+	runs = [import_times() for _ in range(5)]
+	best = min(runs, key=lambda entries: entries[-1][1])
+	total_ms = best[-1][1] / 1000
+	print("import titler: {:.1f} ms (best of {}), budget {} ms".format(total_ms, len(runs), IMPORT_BUDGET_MS))
+	print("{:>10} {:>10}  module".format("self ms", "cumul ms"))
+	for self_time, cumulative, level, name in sorted(best, key=lambda entry: -entry[1])[:12]:
+		print("{:>10.1f} {:>10.1f}  {}".format(self_time / 1000, cumulative / 1000, name))
+
+	start = time.perf_counter()
+	subprocess.run([sys.executable, os.path.join(ROOT, "titler.py"), "--help"], capture_output=True, check=True)
+	print("titler.py --help: {:.1f} ms wall clock, including interpreter start-up".format((time.perf_counter() - start) * 1000))
+
+	failures = []
+	if total_ms > IMPORT_BUDGET_MS:
+		failures.append("import titler took {:.1f} ms, over the {} ms budget".format(total_ms, IMPORT_BUDGET_MS))
+	heavy = loaded_heavy_modules()
+	if heavy:
+		failures.append("import titler loaded " + ", ".join(heavy) + " up front")
+	for failure in failures:
+		print("FAIL: " + failure)
+	sys.exit(1 if failures else 0)
+
+
+if __name__ == "__main__":
+	main()
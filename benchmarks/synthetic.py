@@ -0,0 +1,280 @@
+#!/usr/bin/env python3
+"""
+Throughput benchmark for titler on synthetic Standard Ebooks projects.
+
+Builds a project tree (src/epub/content.opf and src/epub/text/*.xhtml) with a chosen number
+of files, chapter size, nesting depth and heading style, then times titler.main() end-to-end
+on a fresh copy, and each stage of process_file() on its own.
+
+Run from the repository root, eg:
+	python3 benchmarks/synthetic.py --files 400 --paragraphs 200 --depth 2 --headings mixed
+"""
+import argparse
+import contextlib
+import io
+import os
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+import roman
+from bs4 import BeautifulSoup
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import titler  # noqa: E402
+
+HEADING_STYLES = ["roman", "titled", "subtitled", "mixed"]
+
+XHTML_HEAD = """<?xml version="1.0" encoding="utf-8"?>
+<html xmlns="http://www.w3.org/1999/xhtml" xmlns:epub="http://www.idpf.org/2007/ops" epub:prefix="z3998: http://www.daisy.org/z3998/2012/vocab/structure/, se: https://standardebooks.org/vocab/1.0" xml:lang="en-GB">
+	<head>
+		<title>{title}</title>
+		<link href="../css/core.css" rel="stylesheet" type="text/css"/>
+		<link href="../css/local.css" rel="stylesheet" type="text/css"/>
+	</head>
+	<body epub:type="bodymatter z3998:fiction">
+"""
+
+XHTML_FOOT = """	</body>
+</html>
+"""
+
+PARAGRAPH = "<p>It was a dark and stormy night; the rain fell in torrents—except at occasional intervals, when it was checked by a violent gust of wind which swept up the streets (for it is in <i>London</i> that our scene lies), rattling along the housetops, and fiercely agitating the scanty flame of the lamps that struggled against the darkness.</p>"
+
+WORDS = ["the", "adventure", "of", "a", "lost", "letter", "in", "winter", "garden", "stranger", "and", "his", "daughter", "return", "to", "old", "house", "on", "hill"]
+
+CONTENT_OPF = """<?xml version="1.0" encoding="utf-8"?>
+<package xmlns="http://www.idpf.org/2007/opf" dir="ltr" prefix="se: https://standardebooks.org/vocab/1.0" unique-identifier="uid" version="3.0" xml:lang="en-GB">
+	<metadata xmlns:dc="http://purl.org/dc/elements/1.1/">
+		<dc:identifier id="uid">url:https://standardebooks.org/ebooks/synthetic/benchmark</dc:identifier>
+		<dc:title id="title">Synthetic Benchmark</dc:title>
+	</metadata>
+	<manifest>
+{items}
+	</manifest>
+	<spine>
+{itemrefs}
+	</spine>
+</package>
+"""
+
+
+def make_title(number: int) -> str:
+	"""
+	A lowercase pseudo-title, so titler has some titlecasing to do
+	"""
+	words = [WORDS[(number * 7 + index * 3) % len(WORDS)] for index in range(3 + number % 4)]
+	return " ".join(words)
+
+
+def make_heading(number: int, style: str, tag: str, indent: str) -> str:
+	"""
+	A chapter heading in one of HEADING_STYLES
+	"""
+	if style == "mixed":
+		style = HEADING_STYLES[number % (len(HEADING_STYLES) - 1)]
+	numeral = roman.toRoman(number)
+	if style == "roman":
+		return indent + '<' + tag + ' epub:type="title z3998:roman">' + numeral + '</' + tag + '>\n'
+	if style == "titled":
+		return indent + '<' + tag + ' epub:type="title">' + make_title(number) + '</' + tag + '>\n'
+	return (indent + '<' + tag + ' epub:type="title">\n'
+		+ indent + '\t<span epub:type="z3998:roman">' + numeral + '</span>\n'
+		+ indent + '\t<span epub:type="subtitle">' + make_title(number) + '</span>\n'
+		+ indent + '</' + tag + '>\n')
+
+
+def make_chapter(number: int, wrappers: list, style: str, paragraphs: int, collection: bool) -> str:
+	"""
+	A chapter (or short story) file, nested inside the given (id, epub:type) wrapper sections
+	"""
+	lines = [XHTML_HEAD.format(title="Old Title")]
+	indent = "\t\t"
+	for wrapper_id, wrapper_type in wrappers:
+		lines.append(indent + '<section id="' + wrapper_id + '" epub:type="' + wrapper_type + '">\n')
+		indent += "\t"
+	element = "article" if collection else "section"
+	epub_type = "se:short-story" if collection else "chapter"
+	lines.append(indent + '<' + element + ' id="chapter-' + str(number) + '" epub:type="' + epub_type + '">\n')
+	heading_tag = "h" + str(min(2 + len(wrappers), 6))
+	lines.append(make_heading(number, "titled" if collection else style, heading_tag, indent + "\t"))
+	lines.extend(indent + "\t" + PARAGRAPH + "\n" for _ in range(paragraphs))
+	lines.append(indent + '</' + element + '>\n')
+	for _ in wrappers:
+		indent = indent[:-1]
+		lines.append(indent + '</section>\n')
+	lines.append(XHTML_FOOT)
+	return "".join(lines)
+
+
+def make_division(kind: str, number: int, wrappers: list) -> str:
+	"""
+	A part or volume title page, eg <h2 epub:type="title">Part <span epub:type="z3998:roman">II</span></h2>
+	"""
+	lines = [XHTML_HEAD.format(title="Old Title")]
+	indent = "\t\t"
+	for wrapper_id, wrapper_type in wrappers:
+		lines.append(indent + '<section id="' + wrapper_id + '" epub:type="' + wrapper_type + '">\n')
+		indent += "\t"
+	heading_tag = "h" + str(min(2 + len(wrappers) - 1, 6))
+	lines.append(indent + '<' + heading_tag + ' epub:type="title">' + kind.capitalize() + ' <span epub:type="z3998:roman">' + roman.toRoman(number) + '</span></' + heading_tag + '>\n')
+	for _ in wrappers:
+		indent = indent[:-1]
+		lines.append(indent + '</section>\n')
+	lines.append(XHTML_FOOT)
+	return "".join(lines)
+
+
+def generate_project(rootpath: str, files: int, paragraphs: int, depth: int, style: str, collection: bool = False, per_division: int = 10) -> list:
+	"""
+	Write a synthetic Standard Ebooks project.
+
+	INPUTS:
+	rootpath: directory to create the project in
+	files: number of chapter files
+	paragraphs: paragraphs per chapter
+	depth: 1 for plain chapters, 2 for chapters in parts, 3 for chapters in parts in volumes
+	style: one of HEADING_STYLES
+	collection: make the chapters short stories (articles) instead
+	per_division: chapters in each part, and parts in each volume
+
+	OUTPUTS:
+	the spine, as a list of file names
+	"""
+	textpath = os.path.join(rootpath, "src", "epub", "text")
+	os.makedirs(textpath, exist_ok=True)
+	spine = []
+	outer_kinds = ["part", "volume"][:depth - 1]  # innermost first
+	opened = {}
+	for number in range(1, files + 1):
+		wrappers = []
+		for level, kind in enumerate(outer_kinds):
+			division = (number - 1) // (per_division ** (level + 1)) + 1
+			wrappers.insert(0, (kind + "-" + str(division), kind))
+		# a title page for each part or volume, the first time we step inside it
+		for level in range(len(wrappers)):
+			division_id, kind = wrappers[level]
+			if division_id not in opened:
+				opened[division_id] = True
+				file_name = division_id + ".xhtml"
+				with open(os.path.join(textpath, file_name), "w", encoding="utf-8") as fileobject:
+					fileobject.write(make_division(kind, int(division_id.split("-")[1]), wrappers[:level + 1]))
+				spine.append(file_name)
+		file_name = "chapter-" + str(number) + ".xhtml"
+		with open(os.path.join(textpath, file_name), "w", encoding="utf-8") as fileobject:
+			fileobject.write(make_chapter(number, wrappers, style, paragraphs, collection))
+		spine.append(file_name)
+
+	items = "\n".join('\t\t<item href="text/' + name + '" id="' + name + '" media-type="application/xhtml+xml"/>' for name in spine)
+	itemrefs = "\n".join('\t\t<itemref idref="' + name + '"/>' for name in spine)
+	with open(os.path.join(rootpath, "src", "epub", "content.opf"), "w", encoding="utf-8") as fileobject:
+		fileobject.write(CONTENT_OPF.format(items=items, itemrefs=itemrefs))
+	return spine
+
+
+def time_main(rootpath: str, titler_args: list) -> float:
+	"""
+	Run titler.main() on a project as if from the command line.
+	:return: elapsed seconds
+	"""
+	saved_argv = sys.argv
+	sys.argv = ["titler.py"] + titler_args + [rootpath]
+	try:
+		start = time.perf_counter()
+		with contextlib.redirect_stdout(io.StringIO()):
+			try:
+				titler.main()
+			except SystemExit:
+				pass  # eg --check or --dry-run finding work to do
+		return time.perf_counter() - start
+	finally:
+		sys.argv = saved_argv
+
+
+def time_stages(rootpath: str, spine: list, parser: str = "html.parser") -> dict:
+	"""
+	Time each stage of process_file() separately, for every file in the spine.
+	:return: dict mapping stage name to a list of per-file timings in seconds
+	"""
+	timings = {stage: [] for stage in ["gethtml", "parse", "process_first_heading", "get_part_prefix", "format_xhtml", "puthtml"]}
+	textpath = os.path.join(rootpath, "src", "epub", "text")
+	for file_name in spine:
+		file_path = os.path.join(textpath, file_name)
+		start = time.perf_counter()
+		xhtml = titler.gethtml(file_path)
+		timings["gethtml"].append(time.perf_counter() - start)
+
+		start = time.perf_counter()
+		soup = BeautifulSoup(xhtml, titler.PARSERS[parser])
+		heading = soup.find(titler.HEADING_TAGS)
+		timings["parse"].append(time.perf_counter() - start)
+
+		start = time.perf_counter()
+		title_info = titler.process_first_heading(heading)
+		timings["process_first_heading"].append(time.perf_counter() - start)
+
+		start = time.perf_counter()
+		titler.get_part_prefix(title_info, heading.find_parents("section"))
+		new_id = title_info.generate_id()
+		section = heading.find_parent("section")
+		if section:
+			section["id"] = new_id
+		soup.find("title").string = title_info.output_title_tag()
+		timings["get_part_prefix"].append(time.perf_counter() - start)
+
+		start = time.perf_counter()
+		out_xhtml = titler.format_xhtml(str(soup))
+		timings["format_xhtml"].append(time.perf_counter() - start)
+
+		start = time.perf_counter()
+		titler.puthtml(out_xhtml, file_path)
+		timings["puthtml"].append(time.perf_counter() - start)
+	return timings
+
+
+def main():
+	parser = argparse.ArgumentParser(description="Benchmark titler on a synthetic Standard Ebooks project.")
+	parser.add_argument("--files", type=int, default=100, help="number of chapter files (default 100)")
+	parser.add_argument("--paragraphs", type=int, default=50, help="paragraphs per chapter (default 50)")
+	parser.add_argument("--depth", type=int, choices=[1, 2, 3], default=1, help="1: chapters, 2: chapters in parts, 3: chapters in parts in volumes (default 1)")
+	parser.add_argument("--headings", choices=HEADING_STYLES, default="mixed", help="heading style (default mixed)")
+	parser.add_argument("--collection", action="store_true", help="make the chapters short stories in a collection")
+	parser.add_argument("--repeat", type=int, default=3, help="end-to-end runs to take the best of (default 3)")
+	parser.add_argument("--keep", metavar="DIRECTORY", help="generate the project here and keep it, instead of in a temporary directory")
+	parser.add_argument("titler_args", nargs=argparse.REMAINDER, help="extra arguments for titler after --, eg -- --jobs 4")
+	args = parser.parse_args()
+	titler_args = [arg for arg in args.titler_args if arg != "--"]
+
+	workdir = args.keep or tempfile.mkdtemp(prefix="titler-bench-")
+	try:
+		source = os.path.join(workdir, "source")
+		shutil.rmtree(source, ignore_errors=True)
+		spine = generate_project(source, args.files, args.paragraphs, args.depth, args.headings, args.collection)
+		size = sum(os.path.getsize(os.path.join(source, "src", "epub", "text", name)) for name in spine)
+		print("Project: " + str(len(spine)) + " spine files, " + str(size // 1024) + " KiB of xhtml")
+
+		runs = []
+		for _ in range(args.repeat):
+			scratch = os.path.join(workdir, "run")
+			shutil.rmtree(scratch, ignore_errors=True)
+			shutil.copytree(source, scratch)
+			runs.append(time_main(scratch, titler_args))
+		best = min(runs)
+		print("main() " + " ".join(titler_args) + ": best {:.3f} s of {}, {:.1f} files/s".format(best, len(runs), len(spine) / best))
+
+		scratch = os.path.join(workdir, "run")
+		shutil.rmtree(scratch, ignore_errors=True)
+		shutil.copytree(source, scratch)
+		timings = time_stages(scratch, spine)
+		total = sum(sum(values) for values in timings.values())
+		print("{:<22} {:>10} {:>10} {:>7}".format("stage", "total ms", "mean ms", "share"))
+		for stage, values in timings.items():
+			print("{:<22} {:>10.1f} {:>10.3f} {:>6.1f}%".format(stage, sum(values) * 1000, statistics.mean(values) * 1000, 100 * sum(values) / total))
+	finally:
+		if not args.keep:
+			shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+	main()
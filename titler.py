@@ -2,15 +2,94 @@
 """
 process content files and create suitably formatted title tags
 """
+from __future__ import annotations
 import argparse
+import collections
+import contextlib
+import difflib
+import functools
+import hashlib
+import html
+import importlib.util
+import json
 import os
+import stat
+import sys
+import tempfile
+import time
 import unicodedata
 from enum import Enum
-from bs4 import BeautifulSoup, Tag
-import roman
-import regex
-from se.formatting import titlecase
-from se.formatting import format_xhtml
+from html.parser import HTMLParser
+try:
+	import resource
+except ImportError:  # not available on Windows
+	resource = None
+
+
+def lazy_import(name: str):
+	"""
+	Import a module only when one of its attributes is first used, so that
+	eg `--help` doesn't pay for importing bs4 and regex.
+	:param name: name of the module
+	:return: the (not yet loaded) module
+	"""
+	if name in sys.modules:
+		return sys.modules[name]
+	spec = importlib.util.find_spec(name)
+	if spec is None:
+		raise ModuleNotFoundError("No module named " + repr(name), name=name)
+	loader = importlib.util.LazyLoader(spec.loader)
+	spec.loader = loader
+	module = importlib.util.module_from_spec(spec)
+	sys.modules[name] = module
+	loader.exec_module(module)
+	return module
+
+
+bs4 = lazy_import("bs4")
+roman = lazy_import("roman")
+regex = lazy_import("regex")
+
+
+def se_titlecase(text: str) -> str:
+	"""
+	se.formatting.titlecase(), imported on first use since importing se is slow
+	"""
+	from se.formatting import titlecase
+	return titlecase(text)
+
+
+def format_xhtml(xhtml: str) -> str:
+	"""
+	se.formatting.format_xhtml(), imported on first use since importing se is slow
+	"""
+	from se.formatting import format_xhtml as se_format_xhtml
+	return se_format_xhtml(xhtml)
+
+
+__version__ = "0.2.0"
+
+# name of the incremental-mode manifest, stored in the project root
+MANIFEST_NAME = ".titler-manifest.json"
+
+# name of the persistent titlecase/id cache used with --cache, stored in the project root
+CACHE_NAME = ".titler-cache.json"
+
+# maximum number of entries kept in each in-memory cache
+CACHE_SIZE = 4096
+
+# headings we look for; not interested in h1 in halftitle
+HEADING_TAGS = ["h2", "h3", "h4", "h5", "h6"]
+
+# size of the pieces fed to HeadLocator while looking for the first heading
+HEAD_CHUNK_SIZE = 16384
+
+# ways of producing the output text, selectable with --format
+FORMAT_MODES = ["always", "changed", "splice"]
+
+# parsing engines selectable with --parser, mapped to the BeautifulSoup tree builder used for content files;
+# lxml is run strictly (see parse_xhtml())
+PARSERS = {"html.parser": "html.parser", "lxml": "lxml-xml"}
 
 
 class BookDivision(Enum):
@@ -26,19 +105,154 @@ class BookDivision(Enum):
 	VOLUME = 6
 
 
+# epub:type tokens marking each kind of book division, highest priority first, as
+# (token, division, prefix for its titles and ids, tokens which stop it applying);
+# a token also matches when it has a vocabulary prefix, eg "z3998:letter" for "letter"
+DIVISION_TABLE = [
+	("part", BookDivision.PART, "Part", frozenset()),
+	("division", BookDivision.DIVISION, "Division", frozenset()),
+	("volume", BookDivision.VOLUME, "Volume", frozenset({"se:short-story"})),
+	("subchapter", BookDivision.SUBCHAPTER, "", frozenset()),
+	("chapter", BookDivision.CHAPTER, "Chapter", frozenset())
+]
+# the prefix of each kind of division, when it isn't known which token marked it
+DIVISION_PREFIXES = {division: prefix for token, division, prefix, vetoes in reversed(DIVISION_TABLE)}
+# divisions which enclose others, so number the files within them
+ENCLOSING_DIVISIONS = (BookDivision.PART, BookDivision.DIVISION, BookDivision.VOLUME)
+
+
+@functools.lru_cache(maxsize=None)
+def epub_type_names(epub_type: str) -> frozenset:
+	"""
+	:param epub_type: value of an epub:type attribute
+	:return: its tokens, both as they are and without any vocabulary prefix
+	"""
+	tokens = epub_type.split()
+	return frozenset(tokens + [token.rpartition(":")[2] for token in tokens])
+
+
+@functools.lru_cache(maxsize=None)
+def classify_epub_type(epub_type: str) -> tuple:
+	"""
+	:param epub_type: value of an epub:type attribute
+	:return: the division it marks and that division's prefix, from the first entry in DIVISION_TABLE which applies
+		(as a tuple); BookDivision.NONE and "" if none does
+	"""
+	names = epub_type_names(epub_type)
+	for token, division, prefix, vetoes in DIVISION_TABLE:
+		if token in names and not vetoes & names:
+			return division, prefix
+	return BookDivision.NONE, ""
+
+
+def extend_division_table(entries: list):
+	"""
+	Add divisions, eg from --divisions, ahead of the standard ones
+	:param entries: DIVISION_TABLE entries; any already in the table are ignored
+	"""
+	DIVISION_TABLE[:0] = [entry for entry in entries if entry not in DIVISION_TABLE]
+	classify_epub_type.cache_clear()
+
+
+def load_divisions(filename: str) -> list:
+	"""
+	Read extra divisions from a JSON file mapping each epub:type token to the kind of division it marks
+	and the prefix for its titles and ids, eg {"canto": {"division": "chapter", "prefix": "Canto"}}.
+	:param filename: path to the file
+	:return: list of DIVISION_TABLE entries, in the file's order; None if the file can't be used
+	"""
+	try:
+		with open(filename, 'r', encoding='utf-8') as fileobject:
+			stored = json.load(fileobject)
+	except (IOError, ValueError) as ex:
+		print('Could not read ' + filename + ': ' + str(ex))
+		return None
+	entries = []
+	for token, spec in (stored.items() if isinstance(stored, dict) else []):
+		kind = str(spec.get("division", "") if isinstance(spec, dict) else "").upper()
+		if kind not in BookDivision.__members__:
+			print("Error: " + filename + ": '" + token + "' needs a division, one of " + ", ".join(name.lower() for name in BookDivision.__members__))
+			return None
+		entries.append((token, BookDivision[kind], str(spec.get("prefix", "")), frozenset()))
+	if not entries:
+		print("Error: " + filename + " doesn't map any epub:type tokens to divisions")
+		return None
+	return entries
+
+
 class TitleInfo:
 	"""
-	Object to hold information on a title
+	Object to hold information on a title.
+	Built up by process_first_heading() and get_part_prefix(), then frozen by retitle_heading().
 	"""
-	title = ""  # this is for the heading title
-	subtitle = ""  # this is for the heading subtitle if any
-	title_no_embeds = ""  # this is for the <title> tag, no embedded tags
-	subtitle_no_embeds = ""  # this is for the <title> tag, no embedded tags
-	roman = ""
-	number = 0
-	depth = 1
-	id_prefix = ""
-	division = BookDivision
+	# fields, with their defaults, in the order of the serialised format
+	FIELDS = {
+		"title": "",  # this is for the heading title
+		"subtitle": "",  # this is for the heading subtitle if any
+		"title_no_embeds": "",  # this is for the <title> tag, no embedded tags
+		"subtitle_no_embeds": "",  # this is for the <title> tag, no embedded tags
+		"roman": "",
+		"number": 0,
+		"depth": 1,
+		"id_prefix": "",
+		"file_prefix": "",  # id of the enclosing part, for naming files
+		"section_id": "",
+		"division": BookDivision.NONE,
+		"prefix": ""  # eg "Chapter", or "Canto" for a division added with --divisions
+	}
+	# version of the format produced by to_dict(); bump it whenever FIELDS changes
+	FORMAT_VERSION = 2
+	__slots__ = tuple(FIELDS) + ("_frozen",)
+
+	def __init__(self):
+		object.__setattr__(self, "_frozen", False)
+		for name, default in self.FIELDS.items():
+			setattr(self, name, default)
+
+	def __setattr__(self, name, value):
+		if self._frozen:
+			raise AttributeError("TitleInfo is frozen; can't set " + name)
+		object.__setattr__(self, name, value)
+
+	def freeze(self):
+		"""
+		Stop any further changes, once the title information is complete
+		"""
+		object.__setattr__(self, "_frozen", True)
+
+	def to_dict(self) -> dict:
+		"""
+		:return: the title information as a dict of plain values, in a stable format marked with its version
+		"""
+		data = {"version": self.FORMAT_VERSION}
+		for name in self.FIELDS:
+			data[name] = getattr(self, name)
+		data["division"] = self.division.name
+		return data
+
+	@classmethod
+	def from_dict(cls, data: dict) -> TitleInfo:
+		"""
+		:param data: dict from to_dict()
+		:return: a frozen TitleInfo holding the same information
+		"""
+		if data.get("version") != cls.FORMAT_VERSION:
+			raise ValueError("unsupported TitleInfo format version: " + str(data.get("version")))
+		title_info = cls()
+		for name, default in cls.FIELDS.items():
+			setattr(title_info, name, data.get(name, default))
+		title_info.division = BookDivision[data.get("division", "NONE")]
+		title_info.freeze()
+		return title_info
+
+	# pickle (eg between worker processes) through the same format
+	def __getstate__(self) -> dict:
+		return self.to_dict()
+
+	def __setstate__(self, state: dict):
+		copy = self.from_dict(state)
+		for name in self.__slots__:
+			object.__setattr__(self, name, getattr(copy, name))
 
 	def output_title_tag(self) -> str:
 		"""
@@ -64,19 +278,7 @@ class TitleInfo:
 				return self.title_no_embeds
 
 	def generate_prefix(self):
-		if self.division == BookDivision.ARTICLE:
-			prefix = ""
-		elif self.division == BookDivision.CHAPTER:
-			prefix = "Chapter"
-		elif self.division == BookDivision.DIVISION:
-			prefix = "Division"
-		elif self.division == BookDivision.PART:
-			prefix = "Part"
-		elif self.division == BookDivision.VOLUME:
-			prefix = "Volume"
-		else:
-			prefix = ""
-		return prefix
+		return self.prefix or DIVISION_PREFIXES.get(self.division, "")
 
 	def generate_id(self):
 		"""
@@ -96,7 +298,83 @@ class TitleInfo:
 			else:  # unlikely case: subtitle but no title ??
 				if self.subtitle_no_embeds:
 					id_string = self.subtitle_no_embeds
-		return make_url_safe(id_string)
+		return url_safe(id_string)
+
+
+class LruCache:
+	"""
+	Bounded least-recently-used cache of the results of a string function, with hit/miss counts
+	"""
+	def __init__(self, function, maxsize: int = CACHE_SIZE):
+		self.function = function
+		self.maxsize = maxsize
+		self.entries = collections.OrderedDict()
+		self.hits = 0
+		self.misses = 0
+		self.added = None  # when a dict, collects entries computed since the last take_report()
+
+	def __call__(self, text: str) -> str:
+		if text in self.entries:
+			self.hits += 1
+			self.entries.move_to_end(text)
+			return self.entries[text]
+		self.misses += 1
+		result = self.function(text)
+		self.put(text, result)
+		if self.added is not None:
+			self.added[text] = result
+		return result
+
+	def put(self, text: str, result: str):
+		"""
+		Store a result, evicting the least recently used entry if the cache is full
+		"""
+		self.entries[text] = result
+		self.entries.move_to_end(text)
+		if len(self.entries) > self.maxsize:
+			self.entries.popitem(last=False)
+
+	def take_report(self) -> tuple:
+		"""
+		Used in worker processes to pass their new entries and counts back to the main process.
+		:return: tuple of (entries added, hits, misses) since the last report
+		"""
+		report = (self.added or {}, self.hits, self.misses)
+		self.added = {}
+		self.hits = 0
+		self.misses = 0
+		return report
+
+	def merge_report(self, report: tuple):
+		"""
+		Fold a report from take_report() in a worker process into this cache
+		"""
+		added, hits, misses = report
+		for text, result in added.items():
+			self.put(text, result)
+		self.hits += hits
+		self.misses += misses
+
+	def stats(self) -> str:
+		"""
+		:return: a one-line summary of the cache's use
+		"""
+		lookups = self.hits + self.misses
+		rate = (100 * self.hits // lookups) if lookups else 0
+		return str(self.hits) + " hits, " + str(self.misses) + " misses (" + str(rate) + "% hit rate), " + str(len(self.entries)) + " entries"
+
+
+# used by make_url_safe()
+QUOTES_TABLE = str.maketrans("", "", "'‘’\"”“")
+
+
+@functools.lru_cache(maxsize=None)
+def url_safe_regexes() -> tuple:
+	"""
+	The compiled regexes used by make_url_safe(), compiled on first use
+	:return: tuple of (regex matching combining marks, regex matching runs of non-alphanumerics)
+	"""
+	return regex.compile(r"\p{M}"), regex.compile(r"[^0-9a-z]+", flags=regex.IGNORECASE)
 
 
 def make_url_safe(text: str) -> str:
@@ -111,33 +389,207 @@ def make_url_safe(text: str) -> str:
 	"""
 
 	# 1. Convert accented characters to unaccented characters
-	text = regex.sub(r"\p{M}", "", unicodedata.normalize("NFKD", text))
-
 	# 2. Trim
-	text = text.strip()
-
 	# 3. Convert title to lowercase
-	text = text.lower()
+	# 4. Remove apostrophes and double quotes
+	marks_regex, non_alphanumeric_regex = url_safe_regexes()
+	text = marks_regex.sub("", unicodedata.normalize("NFKD", text)).strip().lower().translate(QUOTES_TABLE)
 
-	# 4. Remove apostrophes
-	text = regex.sub(r"['‘’]", "", text)
+	# 5. Convert any run of non-digit, non-letter characters to a dash
+	# 6. Remove trailing dashes
+	return non_alphanumeric_regex.sub("-", text).rstrip("-")
 
-	# 4a. Remove double quotes
-	text = regex.sub(r'["”“]', '', text)
 
-	# 5. Convert any non-digit, non-letter character to a space
-	text = regex.sub(r"[^0-9a-z]", " ", text, flags=regex.IGNORECASE)
+def titlecase(text: str) -> str:
+	"""
+	Titlecase a string with se.formatting.titlecase(), reusing earlier results from TITLECASE_CACHE
+	"""
+	return TITLECASE_CACHE(text)
+
 
-	# 6. Convert any instance of one or more space to a dash
-	text = regex.sub(r"\s+", "-", text)
+def url_safe(text: str) -> str:
+	"""
+	make_url_safe(), reusing earlier results from URL_SAFE_CACHE
+	"""
+	return URL_SAFE_CACHE(text)
 
-	# 7. Remove trailing dashes
-	text = regex.sub(r"\-+$", "", text)
 
-	return text
+TITLECASE_CACHE = LruCache(se_titlecase)
+URL_SAFE_CACHE = LruCache(make_url_safe)
+
+# the caches, by the names used for them in the persistent cache file
+CACHES = {"titlecase": TITLECASE_CACHE, "url_safe": URL_SAFE_CACHE}
+
+
+def cache_version() -> str:
+	"""
+	:return: string identifying the titler and se versions, since cached results depend on both
+	"""
+	from importlib import metadata
+	try:
+		se_version = metadata.version("standardebooks")
+	except metadata.PackageNotFoundError:
+		se_version = "unknown"
+	return __version__ + "/" + se_version
+
+
+def load_caches(rootpath: str) -> dict:
+	"""
+	Read the persistent cache from a project root into the in-memory caches.
+	:param rootpath: Standard Ebooks root directory
+	:return: the cached entries read, by cache name (empty if there were none usable)
+	"""
+	cache_path = os.path.join(rootpath, CACHE_NAME)
+	if not os.path.exists(cache_path):
+		return {}
+	try:
+		with open(cache_path, 'r', encoding='utf-8') as fileobject:
+			stored = json.load(fileobject)
+	except (IOError, ValueError):
+		print('Could not read ' + cache_path + ', ignoring it')
+		return {}
+	if not isinstance(stored, dict) or stored.get("version") != cache_version():
+		return {}
+	entries = {}
+	for name, cache in CACHES.items():
+		entries[name] = stored.get(name) or {}
+		for text, result in entries[name].items():
+			cache.put(text, result)
+	return entries
+
+
+def save_caches(rootpath: str):
+	"""
+	Write the in-memory caches to the persistent cache in a project root.
+	:param rootpath: Standard Ebooks root directory
+	"""
+	cache_path = os.path.join(rootpath, CACHE_NAME)
+	stored = {"version": cache_version()}
+	for name, cache in CACHES.items():
+		stored[name] = dict(cache.entries)
+	try:
+		with open(cache_path, 'w', encoding='utf-8') as fileobject:
+			json.dump(stored, fileobject, ensure_ascii=False, indent=1)
+	except IOError:
+		print('Could not write to ' + cache_path)
+
+
+def peak_rss() -> int:
+	"""
+	:return: peak resident set size of this process so far, in bytes, or 0 where it can't be measured
+	"""
+	if resource is None:
+		return 0
+	peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+	return peak if sys.platform == "darwin" else peak * 1024  # macOS gives bytes, Linux KiB
+
+
+class Profiler:
+	"""
+	Collects timings and peak memory use of each stage of processing for --profile
+	"""
+	def __init__(self):
+		self.current_file = ""
+		self.records = []  # (stage, file name, seconds, peak RSS after the stage, growth in peak RSS during it)
+
+	@contextlib.contextmanager
+	def stage(self, name: str):
+		"""
+		Context manager timing one stage of the work on the current file
+		"""
+		start = time.perf_counter()
+		rss_before = peak_rss()
+		try:
+			yield
+		finally:
+			rss_after = peak_rss()
+			self.records.append((name, self.current_file, time.perf_counter() - start, rss_after, rss_after - rss_before))
+
+	def take_records(self) -> list:
+		"""
+		Used in worker processes to pass their timings back to the main process.
+		:return: the records collected since the last call
+		"""
+		records = self.records
+		self.records = []
+		return records
+
+	def summary(self, slowest: int = 10) -> dict:
+		"""
+		:param slowest: number of slowest files to list
+		:return: dict holding count, total, mean and p95 seconds for each stage,
+			the highest peak RSS in bytes seen by any process at the end of it, and how much it raised peaks in all,
+			and the slowest files with their total seconds
+		"""
+		stages = {}
+		memory = {}
+		files = collections.defaultdict(float)
+		for name, file_name, seconds, rss, rss_growth in self.records:
+			stages.setdefault(name, []).append(seconds)
+			peak, growth = memory.get(name, (0, 0))
+			memory[name] = (max(peak, rss), growth + rss_growth)
+			if file_name:
+				files[file_name] += seconds
+		summary = {"stages": {}, "slowest": []}
+		for name, timings in stages.items():
+			timings.sort()
+			summary["stages"][name] = {
+				"count": len(timings),
+				"total": sum(timings),
+				"mean": sum(timings) / len(timings),
+				"p95": timings[max(0, -(-len(timings) * 95 // 100) - 1)],
+				"peak_rss": memory[name][0],
+				"rss_growth": memory[name][1]
+			}
+		for file_name, seconds in sorted(files.items(), key=lambda item: (-item[1], item[0]))[:slowest]:
+			summary["slowest"].append({"file": file_name, "total": seconds})
+		return summary
+
+	def report(self, output_format: str = "table") -> str:
+		"""
+		:param output_format: "table" for a human-readable report, "json" for JSON
+		:return: the report text
+		"""
+		summary = self.summary()
+		if output_format == "json":
+			return json.dumps(summary, indent=1)
+		lines = ["{:<22} {:>6} {:>11} {:>10} {:>10} {:>10} {:>8}".format("stage", "count", "total ms", "mean ms", "p95 ms", "peak MiB", "+MiB")]
+		for name, stage in summary["stages"].items():
+			lines.append("{:<22} {:>6} {:>11.1f} {:>10.3f} {:>10.3f} {:>10.1f} {:>8.1f}".format(name, stage["count"], stage["total"] * 1000, stage["mean"] * 1000, stage["p95"] * 1000, stage["peak_rss"] / MIB, stage["rss_growth"] / MIB))
+		if summary["slowest"]:
+			lines.append("")
+			lines.append("slowest files:")
+			for entry in summary["slowest"]:
+				lines.append("{:>11.1f} ms  {}".format(entry["total"] * 1000, entry["file"]))
+		return "\n".join(lines)
+
+
+MIB = 1024 * 1024
+
+# set to a Profiler by --profile; when None, timed() costs next to nothing
+PROFILER = None
+NOT_TIMED = contextlib.nullcontext()
 
 
-def get_content_files(opf: BeautifulSoup) -> list:
+def timed(stage: str):
+	"""
+	:param stage: name of a stage of processing
+	:return: context manager timing the stage if profiling is on
+	"""
+	if PROFILER:
+		return PROFILER.stage(stage)
+	return NOT_TIMED
+
+
+def profile_file(filepath: str):
+	"""
+	Tell the profiler which file the following stages belong to
+	"""
+	if PROFILER:
+		PROFILER.current_file = os.path.basename(filepath)
+
+
+def get_content_files(opf: bs4.BeautifulSoup) -> list:
 	"""
 	Reads the spine from content.opf to obtain a list of content files, in the order wanted for the ToC.
 	"""
@@ -165,35 +617,314 @@ def gethtml(filename: str) -> str:
 
 def puthtml(html: str, filename: str):
 	"""
-	Write out the new xhtml
+	Write out the new xhtml, unless the file already holds exactly that text
 	:param html: input html text
 	:param filename: file to write to
+	:return: True if the file was written, False if it was left unchanged, None if it could not be written
 	"""
+	if os.path.exists(filename):
+		try:
+			with open(filename, 'r', encoding='utf-8') as fileobject:
+				if fileobject.read() == html:
+					return False  # leave the file (and its mtime) alone
+		except (IOError, UnicodeDecodeError):
+			pass  # just try to overwrite it
 	try:
 		fileobject = open(filename, 'w', encoding='utf-8')
 		fileobject.write(html)
 	except IOError:
 		print('Could not write to ' + filename)
-		return
+		return None
 	fileobject.close()
+	return True
+
+
+def sync_directory(path: str):
+	"""
+	fsync a directory, so that renames within it are durable. Not possible on all platforms; ignored there.
+	"""
+	try:
+		descriptor = os.open(path, os.O_RDONLY)
+	except OSError:
+		return
+	try:
+		os.fsync(descriptor)
+	except OSError:
+		pass
+	finally:
+		os.close(descriptor)
+
+
+@functools.lru_cache(maxsize=None)
+def default_file_mode() -> int:
+	"""
+	:return: the permissions open() gives a new file under the current umask
+	"""
+	umask = os.umask(0)
+	os.umask(umask)
+	return 0o666 & ~umask
+
+
+class WriteBatch:
+	"""
+	Two-phase alternative to puthtml() for --atomic: stage() writes each output to a temporary file
+	beside its target, then commit() renames them all into place. If anything fails, rollback()
+	discards the temporary files and restores any targets already replaced.
+	"""
+	def __init__(self, sync_files: bool = True):
+		"""
+		:param sync_files: fsync each staged file; if False, only the directories are synced on commit
+		"""
+		self.sync_files = sync_files
+		self.staged = []  # (temporary path, target path, original text or None if the target is new)
+		self.replaced = []  # staged entries already renamed into place by commit()
+
+	def stage(self, html: str, filename: str, source: str = None):
+		"""
+		Stage the new xhtml for a file, unless the file already holds exactly that text
+		:param html: input html text
+		:param filename: file to write to
+		:param source: the file being renamed to filename, if any, whose permissions the new file takes
+		:return: True if the file was staged, False if it was left unchanged, None if it could not be staged
+		"""
+		original = None
+		mode = default_file_mode()
+		if os.path.exists(filename):
+			try:
+				with open(filename, 'r', encoding='utf-8') as fileobject:
+					original = fileobject.read()
+				mode = stat.S_IMODE(os.stat(filename).st_mode)
+			except (IOError, UnicodeDecodeError):
+				print('Could not read ' + filename)
+				return None
+			if original == html:
+				return False
+		try:
+			if source and source != filename:
+				mode = stat.S_IMODE(os.stat(source).st_mode)
+			descriptor, temp_path = tempfile.mkstemp(prefix="." + os.path.basename(filename) + ".", suffix=".tmp", dir=os.path.dirname(filename) or ".")
+			# mkstemp() creates the file readable only by its owner, and the rename would carry that over
+			os.chmod(temp_path, mode)
+			with open(descriptor, 'w', encoding='utf-8') as fileobject:
+				fileobject.write(html)
+				if self.sync_files:
+					fileobject.flush()
+					os.fsync(fileobject.fileno())
+		except IOError:
+			print('Could not write to ' + filename)
+			return None
+		self.staged.append((temp_path, filename, original))
+		return True
+
+	def commit(self) -> bool:
+		"""
+		Rename all the staged files into place, then sync their directories
+		:return: True if every file was committed; if not, the caller should call rollback()
+		"""
+		try:
+			for entry in self.staged:
+				os.replace(entry[0], entry[1])
+				self.replaced.append(entry)
+		except OSError as ex:
+			print('Could not commit ' + entry[1] + ': ' + str(ex))
+			return False
+		for directory in sorted({os.path.dirname(entry[1]) or "." for entry in self.staged}):
+			sync_directory(directory)
+		return True
+
+	def rollback(self):
+		"""
+		Undo a failed batch: restore any files already replaced and remove the remaining temporary files
+		"""
+		for temp_path, filename, original in self.replaced:
+			try:
+				if original is None:
+					os.remove(filename)
+				else:
+					with open(filename, 'w', encoding='utf-8') as fileobject:
+						fileobject.write(original)
+			except IOError:
+				print('Could not restore ' + filename)
+		for temp_path, filename, original in self.staged:
+			if os.path.exists(temp_path):
+				os.remove(temp_path)
+		self.staged = []
+		self.replaced = []
+
+
+def content_hash(text: str) -> str:
+	"""
+	Return a stable hash of some file text, for the incremental manifest
+	"""
+	return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+def manifest_options(args) -> str:
+	"""
+	:param args: the parsed command line
+	:return: a hash of the settings besides a file's own text which decide titler's output for it:
+		the titler and standardebooks versions, --format, --fast, --parser and the division table (as extended by --divisions)
+	"""
+	divisions = [[token, division.name, prefix, sorted(vetoes)] for token, division, prefix, vetoes in DIVISION_TABLE]
+	return content_hash(json.dumps([cache_version(), args.format_mode, args.fast, args.parser, divisions]))
+
+
+def manifest_entry(text_hash: str, context: SpineContext = None) -> str:
+	"""
+	The manifest's record of one file: the content_hash() of its text, and the numbers of the parts, divisions
+	and volumes enclosing its heading, which depend on the files before it in the spine
+	:param text_hash: content_hash() of the file's text
+	:param context: the file's SpineContext from the spine index, if it has a heading
+	"""
+	ordinals = [element.ordinal for element in context.elements] if context else []
+	return text_hash + "/" + ",".join(str(ordinal) for ordinal in ordinals)
 
 
-def extract_contents_as_string(tag: Tag) -> str:
+def load_manifest(rootpath: str, options: str) -> dict:
+	"""
+	Read the incremental manifest from a project root.
+	:param rootpath: Standard Ebooks root directory
+	:param options: manifest_options() for this run
+	:return: dict mapping file paths (relative to the root) to the manifest_entry() of titler's last output;
+		empty if there is no manifest or it was written by a different version of titler or with different options
+	"""
+	manifest_path = os.path.join(rootpath, MANIFEST_NAME)
+	if not os.path.exists(manifest_path):
+		return {}
+	try:
+		with open(manifest_path, 'r', encoding='utf-8') as fileobject:
+			manifest = json.load(fileobject)
+	except (IOError, ValueError):
+		print('Could not read ' + manifest_path + ', ignoring it')
+		return {}
+	if not isinstance(manifest, dict) or manifest.get("version") != __version__ or manifest.get("options") != options:
+		return {}
+	return manifest.get("files") or {}
+
+
+def save_manifest(rootpath: str, files: dict, options: str):
+	"""
+	Write the incremental manifest to a project root.
+	:param rootpath: Standard Ebooks root directory
+	:param files: dict mapping file paths (relative to the root) to manifest_entry() of their output
+	:param options: manifest_options() for this run
+	"""
+	manifest_path = os.path.join(rootpath, MANIFEST_NAME)
+	try:
+		with open(manifest_path, 'w', encoding='utf-8') as fileobject:
+			json.dump({"version": __version__, "options": options, "files": files}, fileobject, indent=1, sort_keys=True)
+	except IOError:
+		print('Could not write to ' + manifest_path)
+
+
+def extract_contents_as_string(tag: bs4.Tag) -> str:
 	"""
 	Get text only from contents of tag
 	:param tag: Beautiful Soup Tag
 	:return: text of the tag
 	"""
-	accumulator = ""
-	for content in tag.contents:
-		accumulator += str(content)
-	return accumulator
+	return "".join([str(content) for content in tag.contents])
+
+
+def collapse_whitespace(text: str) -> str:
+	"""
+	:param text: text or markup
+	:return: the text with each run of layout whitespace made a single space, and none at either end;
+		no-break and other non-ASCII spaces are left alone
+	"""
+	return regex.sub(r"[ \t\n\r\f]+", " ", text).strip(" ")
+
+
+# stands in HeadingParts.signature for text directly inside a heading
+TEXT_SHAPE = ("#text", "")
+
+
+def span_kind(span: bs4.Tag) -> str:
+	"""
+	:return: "roman" for a span holding a roman numeral, "subtitle" for a subtitle, otherwise "" (a title)
+	"""
+	epub_type = span.get("epub:type") or ""
+	if "z3998:roman" in epub_type:
+		return "roman"
+	if "subtitle" in epub_type:
+		return "subtitle"
+	return ""
+
+
+class HeadingParts:
+	"""
+	What process_first_heading() needs to know about a heading, gathered in one pass over its children:
+	its contents as markup (with any embedded tags) and as plain text, its structure,
+	and the same for each span directly inside it.
+	Markup is built as extract_contents_as_string() builds it, and text as get_text() does.
+	"""
+	def __init__(self, heading: bs4.Tag):
+		markup = []
+		text = []
+		shape = []
+		self.spans = []  # (span tag, span_kind(), contents as markup, text) of each span directly inside the heading
+		types = heading.interesting_string_types or bs4.element.Tag.MAIN_CONTENT_STRING_TYPES
+		for child in heading.contents:
+			child_markup = str(child)
+			if isinstance(child, bs4.Tag):
+				child_text = child.get_text()
+				kind = ""
+				if child.name == "span":
+					kind = span_kind(child)
+					self.spans.append((child, kind, extract_contents_as_string(child), child_text))
+				elif child.name == "a" and "noteref" in (child.get("epub:type") or ""):
+					kind = "noteref"
+				shape.append((child.name, kind))
+			elif type(child) is types if isinstance(types, type) else type(child) in types:
+				child_text = child_markup
+				if not child_text.isspace() and shape[-1:] != [TEXT_SHAPE]:
+					shape.append(TEXT_SHAPE)
+			else:
+				child_text = ""  # eg a comment, which get_text() leaves out
+			markup.append(child_markup)
+			text.append(child_text)
+		self.markup = "".join(markup)
+		self.text = "".join(text)
+		# layout whitespace is left out, so a heading has the same signature however it's formatted
+		self.signature = ("z3998:roman" in (heading.get("epub:type") or ""), tuple(shape))
+
+
+@functools.lru_cache(maxsize=None)
+def classify_heading(signature: tuple) -> str:
+	"""
+	Decide how to read a heading from its structure. Books repeat a few heading shapes many times,
+	so each shape is only worked out once.
+
+	INPUTS:
+	signature: HeadingParts.signature: whether the heading itself is marked as a roman numeral,
+	and the name (and for a span, span_kind(); for a noteref, "noteref") of each element directly inside it,
+	with TEXT_SHAPE wherever it has text of its own
+
+	OUTPUTS:
+	"roman" for a bare numeral, eg <h2 epub:type="title z3998:roman">XIV</h2>;
+	"spans" for a heading made up of spans, eg a numeral and a subtitle, perhaps with noterefs,
+	line breaks or punctuation between them;
+	"title" for a title given as the heading's text, eg <h3 epub:type="title">Prelude</h3>;
+	or "" for an empty heading
+	"""
+	roman_heading, shape = signature
+	if roman_heading and shape == (TEXT_SHAPE,):
+		return "roman"
+	# noterefs and line breaks aren't part of the title, wherever they are
+	parts = [part for part in shape if part[0] != "br" and part[1] != "noteref"]
+	spans = [index for index, (name, kind) in enumerate(parts) if name == "span"]
+	if spans and all(part[0] == "span" or (part == TEXT_SHAPE and spans[0] < index < spans[-1]) for index, part in enumerate(parts)):
+		return "spans"
+	if shape:
+		return "title"
+	return ""
 
 
-def process_first_heading(heading: BeautifulSoup) -> TitleInfo:
+def process_first_heading(heading: bs4.BeautifulSoup, context: SpineContext = None) -> TitleInfo:
 	"""
 	Get title and subtitle text from heading
 	INPUTS: heading: a soup object representing a heading
+		context: the heading's enclosing elements from the spine index, if known
 		We make some assumptions: should be either single line like:
 		<h2 epub:type="title z3998:roman">XIV</h2>
 		or multiline like
@@ -204,8 +935,9 @@ def process_first_heading(heading: BeautifulSoup) -> TitleInfo:
 	OUTPUTS:  object containing title information
 	"""
 	title_info = TitleInfo()
-	title_info.division = get_book_division(heading)
-	temp_title = extract_contents_as_string(heading)  # this includes any embedded tags
+	title_info.division, title_info.prefix = get_book_division(context or heading)
+	parts = HeadingParts(heading)
+	temp_title = parts.markup  # this includes any embedded tags
 
 	# the trickiest case to handle is a heading like <h2 epub:type="title">Book <span epub:type="z3998:roman">IV</span></h2>
 	# so we have to separately filter for such cases FIRST
@@ -214,51 +946,73 @@ def process_first_heading(heading: BeautifulSoup) -> TitleInfo:
 		title_info.title_no_embeds = match.group(1) + " " + str(roman.fromRoman(match.group(2)))  # eg "Book 3"
 		title_info.title = titlecase(temp_title)  # this leaves roman numerals alone, eg "Book IV"
 		# there are no subtitles
-		title_info.section_id = make_url_safe(title_info.title_no_embeds)
+		title_info.section_id = url_safe(title_info.title_no_embeds)
 		# no more to do
 		return title_info
 
-	# now we have to deal with other 'single-line' headings,
+	# now the other headings, told apart by their structure,
 	# eg <h2 epub:type="title epub:type="z3998:roman">IV</h2> or <h3 epub:type="title">Prelude</h3>
-	line_count = str(heading).count("\n") + 1
-	if line_count == 1:
-		epub_type = heading.get("epub:type") or ""
-		if epub_type:
-			if "z3998:roman" in epub_type:
-				title_info.roman = heading.get_text()
-				title_info.number = roman.fromRoman(title_info.roman)
-				# no subtitles
-				title_info.section_id = title_info.generate_id()
-				# no need to do titlecasing
-				return title_info
-			else:
-				title_info.title = titlecase(extract_contents_as_string(heading))
-				title_info.title_no_embeds = titlecase(heading.get_text())
-				return title_info
-
-	spans = heading.find_all("span", recursive=False)  # only want spans which are immediate descendants
-	if spans:
-		for span in spans:
-			epub_type = span.get("epub:type") or ""
-			if "z3998:roman" in epub_type:
-				title_info.roman = span.get_text()
+	kind = classify_heading(parts.signature)
+	if kind == "roman":
+		title_info.roman = parts.text.strip()
+		title_info.number = roman.fromRoman(title_info.roman)
+		# no subtitles
+		title_info.section_id = title_info.generate_id()
+		# no need to do titlecasing
+		return title_info
+	elif kind == "title":
+		# a heading laid out across lines reads the same as one on a single line, eg once format_xhtml() has run
+		title_info.title = titlecase(collapse_whitespace(temp_title))
+		title_info.title_no_embeds = titlecase(collapse_whitespace(parts.text))
+		return title_info
+
+	if kind == "spans":  # only spans which are immediate descendants
+		for span, role, span_markup, span_text in parts.spans:
+			if role == "roman":
+				title_info.roman = span_text
 				title_info.number = roman.fromRoman(title_info.roman)
-			elif "subtitle" in epub_type:
-				title_info.subtitle_no_embeds = titlecase(span.get_text())
-				title_info.subtitle = titlecase(extract_contents_as_string(span))
+			elif role == "subtitle":
+				title_info.subtitle_no_embeds = titlecase(span_text)
+				title_info.subtitle = titlecase(span_markup)
 				# replace subtitle text with titlecased version
 				update_span(span, title_info.subtitle)
 			else:
 				# no epub:type in span so must be simple title
-				title_info.title = titlecase(extract_contents_as_string(span))
-				title_info.title_no_embeds = titlecase(span.get_text())
+				title_info.title = titlecase(span_markup)
+				title_info.title_no_embeds = titlecase(span_text)
 				# replace title text in span with titlecased version
 				update_span(span, title_info.title)
-		return title_info
+
+	# an empty heading has no title to give
+	return title_info
+
+
+@functools.lru_cache(maxsize=None)
+def plain_text_regex():
+	"""
+	Compiled on first use, so that importing titler doesn't load regex.
+	:return: regex matching markup with no tags, and no character references other than &amp; &lt; and &gt;,
+	which parses to just its unescaped text
+	"""
+	return regex.compile(r"[^<&]*(?:&(?:amp;|lt;|gt;|(?=\s)|$)[^<&]*)*")
 
 
 def update_span(span, textstr):
-	sup = BeautifulSoup(textstr, "html.parser")
+	"""
+	Replace the contents of a span with (titlecased) markup.
+	Plain text is set as a string directly, and left alone if it's what the span already holds;
+	only markup with tags in it has to be parsed.
+	"""
+	text = html.unescape(textstr) if plain_text_regex().fullmatch(textstr) else None
+	# the parser collapses text that's only ASCII whitespace, so leave that to it
+	if text is not None and (text == "" or text.strip(" \t\n\r\f")):
+		if len(span.contents) == 1 and type(span.contents[0]) is bs4.NavigableString and span.contents[0] == text:
+			return  # unchanged
+		span.clear()
+		if text:
+			span.append(bs4.NavigableString(text))
+		return
+	sup = bs4.BeautifulSoup(textstr, "html.parser")
 	span.clear()
 	span.append(sup)
 
@@ -270,7 +1024,7 @@ def get_part_prefix(title_info: TitleInfo, sections: list):
 
 	INPUTS:
 	title_info: TitleInfo object to update
-	sections: sequence of outer section tags (BeautifulSoup tags)
+	sections: sequence of outer section tags (BeautifulSoup tags or ContextElements), innermost first
 
 	OUTPUTS:
 	Updated TitleInfo objectstring holding prefix of the part, eg '3-2'
@@ -284,124 +1038,1432 @@ def get_part_prefix(title_info: TitleInfo, sections: list):
 	epub_type = sections[1].get("epub:type") or ""
 	if not epub_type:
 		return  # nothing to do
-	if "part" not in epub_type and "division" not in epub_type and "volume" not in epub_type:
+	names = epub_type_names(epub_type)
+	# any token for an enclosing division will do here, even one vetoed for the heading's own division
+	if not any(token in names for token, division, prefix, vetoes in DIVISION_TABLE if division in ENCLOSING_DIVISIONS):
 		return  # nothing to do
 	section_id = sections[1].get("id") or ""
 	if not section_id:
 		return  # nothing to do
 	# is it in a short-story collection? In this case, we want the full outer section id eg 'book-1'
 	inner_epub_type = sections[0].get("epub:type") or ""
-	if "short-story" in inner_epub_type:
+	if "short-story" in epub_type_names(inner_epub_type):
 		title_info.id_prefix = section_id
 	else:  # just want the numeric bit eg '1'
 		title_info.file_prefix = section_id
 		match = regex.search(r"\w+[-](\d{1,}.*?)", section_id)
 		if match:
 			title_info.id_prefix = match.group(1)
+		elif getattr(sections[1], "ordinal", 0):
+			# no number in the id (eg 'part-the-first'), so number the part by its place in the spine
+			title_info.id_prefix = str(sections[1].ordinal)
 
 
-def process_file(filepath: str) -> (str, str):
+def retitle_heading(heading: bs4.Tag, context: SpineContext = None) -> (TitleInfo, str):
 	"""
-	Run through each file, locating titles and updating <title> tag.
+	Analyse the first heading of a file, titlecasing its spans in place.
 
 	INPUTS:
-	filepath: path to content file
+	heading: the first h2-h6 tag in the file
+	context: the heading's enclosing elements from the spine index; if None, they are found from the heading's parents
 
 	OUTPUTS:
-	altered xhtml file text and new section ID (as a tuple)
-	"""
-	xhtml = gethtml(filepath)
-	soup = BeautifulSoup(xhtml, "html.parser")
-	heading = soup.find(["h2", "h3", "h4", "h5", "h6"])  # find first heading, not interested in h1 in halftitle
-	if heading:
-		title_info = process_first_heading(heading)
-		title_tag = soup.find("title")
-		sections = heading.find_parents("section")
+	title information and new section ID (as a tuple)
+	"""
+	with timed("process_first_heading"):
+		title_info = process_first_heading(heading, context)
+	with timed("get_part_prefix"):
+		sections = (context or heading).find_parents("section")
 		get_part_prefix(title_info, sections)
 		new_id = title_info.generate_id()
-		section = heading.find_parent("section")
-		if section:
-			section["id"] = new_id
-		if title_tag:
-			title_tag.clear()
-			title_tag.append(title_info.output_title_tag())
-		return format_xhtml(str(soup)), new_id
-	# failure, so return blanks
-	return "", ""
+	title_info.freeze()
+	return title_info, new_id
 
 
-def get_book_division(tag: BeautifulSoup) -> BookDivision:
+@functools.lru_cache(maxsize=None)
+def strict_xml_builder() -> type:
 	"""
-	Determine and return the kind of book division.
-	At present only Chapter, Part, Division and Volume are important;
-	but others stored for possible future logic.
+	BeautifulSoup's lxml XML tree builder, with lxml's recovery from errors turned off:
+	recovering from eg an entity XML doesn't define, like &nbsp;, silently drops it and the text around it.
+	Built on first use, since it needs lxml.
+	:return: the tree builder class
 	"""
-	parent_section = tag.find_parents(["section", "article"])
-	if not parent_section:
-		parent_section = tag.find_parents("body")
-	if not parent_section:
-		return BookDivision.NONE
-	section_epub_type = parent_section[0].get("epub:type") or ""
-	if "part" in section_epub_type:
-		return BookDivision.PART
-	elif "division" in section_epub_type:
-		return BookDivision.DIVISION
-	elif ("volume" in section_epub_type) and ("se:short-story" not in section_epub_type):
-		return BookDivision.VOLUME
-	elif "subchapter" in section_epub_type:
-		return BookDivision.SUBCHAPTER
-	elif "chapter" in section_epub_type:
-		return BookDivision.CHAPTER
-	elif "article" in parent_section[0].name:
-		return BookDivision.ARTICLE
-	else:
-		return BookDivision.NONE
+	from lxml import etree
+	from bs4.builder._lxml import LXMLTreeBuilderForXML
 
+	class StrictXMLTreeBuilder(LXMLTreeBuilderForXML):
+		def parser_for(self, encoding):
+			return etree.XMLParser(target=self, recover=False, huge_tree=self.huge_tree, encoding=encoding)
 
-# don't process these files
-EXCLUDE_LIST = ["titlepage.xhtml", "colophon.xhtml", "uncopyright.xhtml", "imprint.xhtml", "halftitle.xhtml", "dedication.xhtml", "endnotes.xhtml", "loi.xhtml"]
+	return StrictXMLTreeBuilder
 
 
-def main():
-	parser = argparse.ArgumentParser(description="Process titles and subtitles, set title case and update <title> tags.")
-# 	parser.add_argument("-i", "--in_place", action="store_true", help="overwrite the existing xhtml files instead of printing to stdout")
-	parser.add_argument("-r", "--rename", action="store_true", help="create xhtml files named for story titles")
-	parser.add_argument("directory", metavar="DIRECTORY", help="a Standard Ebooks source directory")
-	args = parser.parse_args()
+def parse_xhtml(xhtml: str, parser: str, filepath: str) -> bs4.BeautifulSoup:
+	"""
+	Parse content-file markup with the chosen engine. lxml is strict, so markup it can't parse
+	exactly as written is parsed with html.parser instead, rather than losing some of its text.
 
-	rootpath = args.directory
-	opfpath = os.path.join(rootpath, 'src', 'epub', 'content.opf')
-	textpath = os.path.join(rootpath, 'src', 'epub', 'text')
+	INPUTS:
+	xhtml: the markup
+	parser: parsing engine to use, one of the keys of PARSERS
+	filepath: the file the markup comes from, for messages
 
-	if not os.path.exists(opfpath):
-		print("Error: this does not seem to be a Standard Ebooks root directory")
-		exit(-1)
+	OUTPUTS:
+	the parsed soup
+	"""
+	if PARSERS[parser] == "lxml-xml":
+		from lxml import etree
+		try:
+			return bs4.BeautifulSoup(xhtml, builder=strict_xml_builder())
+		except etree.XMLSyntaxError as ex:
+			print("lxml could not parse " + filepath + " (" + str(ex) + "), so html.parser is used for it")
+	return bs4.BeautifulSoup(xhtml, PARSERS["html.parser"])
 
-	xhtml = gethtml(opfpath)
-	soup = BeautifulSoup(xhtml, "lxml")
-	file_list = get_content_files(soup)
-	processed = 0
-	for file_name in file_list:
-		if file_name in EXCLUDE_LIST:  # ignore it
-			continue
-		result = process_file(os.path.join(textpath, file_name))
-		if result[0] != "":
-			out_xhtml = result[0]
-			processed += 1
-			# if args.in_place:
-			# 	puthtml(out_xhtml, os.path.join(textpath, file_name))
-			if args.rename:
-				if result[1] != "":
-					renamed_fname = result[1] + ".xhtml"
-					puthtml(out_xhtml, os.path.join(textpath, renamed_fname))
+
+def process_file(filepath: str, parser: str = "html.parser", format_mode: str = "always", output: bool = True, context: SpineContext = None) -> (str, str, TitleInfo):
+	"""
+	Run through each file, locating titles and updating <title> tag.
+
+	INPUTS:
+	filepath: path to content file
+	parser: parsing engine to use, one of the keys of PARSERS
+	format_mode: one of FORMAT_MODES; "always" reformats the whole file with format_xhtml(),
+		"changed" only does so if the title, heading or section id changed,
+		"splice" patches the changes into the original text without reformatting
+	output: if False, only analyse the heading and don't produce the altered text
+	context: the heading's enclosing elements from the spine index, if known
+
+	OUTPUTS:
+	altered xhtml file text (None if output is False), new section ID and title information (as a tuple)
+	"""
+	profile_file(filepath)
+	with timed("gethtml"):
+		xhtml = gethtml(filepath)
+	with timed("parse"):
+		soup = parse_xhtml(xhtml, parser, filepath)
+		heading = soup.find(HEADING_TAGS)  # find first heading, not interested in h1 in halftitle
+	try:
+		if heading:
+			spans = heading.find_all("span", recursive=False)
+			original_spans = [span.decode_contents() for span in spans]
+			title_info, new_id = retitle_heading(heading, context)
+			if not output:
+				return None, new_id, title_info
+			if format_mode == "splice":
+				with timed("splice"):
+					locator = locate_head(xhtml)
+					out_xhtml = splice_changes(xhtml, locator, title_info, new_id, spans, original_spans) if locator else None
+				if out_xhtml is None:
+					print("Could not locate the heading in " + filepath)
+					return "", "", None
+				return out_xhtml, new_id, title_info
+			changed = [span.decode_contents() for span in spans] != original_spans
+			title_tag = soup.find("title")
+			section = heading.find_parent("section")
+			if section:
+				changed = changed or section.get("id") != new_id
+				section["id"] = new_id
+			if title_tag:
+				new_title = title_info.output_title_tag()
+				changed = changed or title_tag.get_text() != new_title
+				title_tag.clear()
+				title_tag.append(new_title)
+			if format_mode == "changed" and not changed:
+				return xhtml, new_id, title_info
+			with timed("format_xhtml"):
+				out_xhtml = format_xhtml(str(soup))
+			return out_xhtml, new_id, title_info
+		# failure, so return blanks
+		return "", "", None
+	finally:
+		# break up the tree now, rather than leave its reference cycles to the garbage collector
+		soup.decompose()
+
+
+class _HeadingFound(Exception):
+	"""
+	Raised by HeadLocator to abandon parsing once the first heading is complete
+	"""
+
+
+class HeadLocator(HTMLParser):
+	"""
+	Event-based scan of xhtml text which stops at the end of the first heading.
+	Records where the <title> contents, the heading and the start tags of its
+	enclosing elements sit in the source text, as character offsets.
+	"""
+	# elements whose start tags are kept to rebuild the heading's context
+	CONTEXT_TAGS = ("html", "body", "section", "article")
+
+	def __init__(self, text: str):
+		super().__init__()
+		self.text = text
+		self.line_starts = [0]
+		self.stack = []  # (name, start offset, start tag text, attributes) of open context elements
+		self.title_start = -1  # offset of the start of the <title> contents
+		self.title_end = -1  # offset of the end of the <title> contents
+		self.heading_name = ""
+		self.heading_start = -1
+		self.heading_end = -1
+		self.heading_depth = 0  # number of elements open inside the heading
+		self.spans = []  # [contents start, contents end] of each span directly inside the heading
+		self.ancestors = []  # snapshot of self.stack when the heading started
+
+	def source_offset(self) -> int:
+		"""
+		:return: character offset in the text of the construct currently being parsed
+		"""
+		line, column = self.getpos()
+		# extend the table of line start offsets only as far as the parser has got
+		while len(self.line_starts) < line:
+			newline = self.text.find("\n", self.line_starts[-1])
+			self.line_starts.append(newline + 1)
+		return self.line_starts[line - 1] + column
+
+	def handle_starttag(self, tag, attrs):
+		if self.heading_name:
+			if tag == "span" and self.heading_depth == 0:
+				self.spans.append([self.source_offset() + len(self.get_starttag_text()), -1])
+			self.heading_depth += 1
+			return
+		start = self.source_offset()
+		if tag in HEADING_TAGS:
+			self.heading_name = tag
+			self.heading_start = start
+			self.ancestors = list(self.stack)
+		elif tag in self.CONTEXT_TAGS:
+			self.stack.append((tag, start, self.get_starttag_text(), dict(attrs)))
+		elif tag == "title" and self.title_start < 0:
+			self.title_start = start + len(self.get_starttag_text())
+
+	def handle_endtag(self, tag):
+		if self.heading_name:
+			if self.heading_depth == 0:
+				if tag == self.heading_name:
+					self.heading_end = self.text.index(">", self.source_offset()) + 1
+					raise _HeadingFound()
+				return  # stray end tag
+			self.heading_depth -= 1
+			if tag == "span" and self.heading_depth == 0 and self.spans:
+				self.spans[-1][1] = self.source_offset()
+		elif tag in self.CONTEXT_TAGS:
+			if self.stack and self.stack[-1][0] == tag:
+				self.stack.pop()
+		elif tag == "title" and self.title_start >= 0 > self.title_end:
+			self.title_end = self.source_offset()
+
+	def context_markup(self) -> str:
+		"""
+		:return: a small document holding just the heading and its enclosing elements
+		"""
+		opening = "".join(ancestor[2] for ancestor in self.ancestors)
+		closing = "".join("</" + ancestor[0] + ">" for ancestor in reversed(self.ancestors))
+		return opening + self.text[self.heading_start:self.heading_end] + closing
+
+
+def locate_head(xhtml: str) -> HeadLocator:
+	"""
+	Feed xhtml text to a HeadLocator piece by piece until the first heading has been read.
+	:param xhtml: text of a content file
+	:return: the locator, or None if the text has no h2-h6 heading
+	"""
+	locator = HeadLocator(xhtml)
+	try:
+		for position in range(0, len(xhtml), HEAD_CHUNK_SIZE):
+			locator.feed(xhtml[position:position + HEAD_CHUNK_SIZE])
+	except _HeadingFound:
+		return locator
+	return None
+
+
+def splice_text(text: str, edits: list) -> str:
+	"""
+	Replace regions of a text.
+	:param text: original text
+	:param edits: list of (start offset, end offset, replacement) tuples, which must not overlap
+	:return: the text with each region replaced
+	"""
+	pieces = []
+	position = 0
+	for start, end, replacement in sorted(edits):
+		pieces.append(text[position:start])
+		pieces.append(replacement)
+		position = end
+	pieces.append(text[position:])
+	return "".join(pieces)
+
+
+def set_id_attribute(start_tag: str, new_id: str) -> str:
+	"""
+	Set the id attribute in the source text of a start tag.
+	:param start_tag: eg '<section id="chapter-1" epub:type="chapter">'
+	:param new_id: the id wanted
+	:return: the start tag with its id replaced, or added if it had none
+	"""
+	attribute = 'id="' + html.escape(new_id) + '"'
+	match = regex.search(r"""(?<=\s)id\s*=\s*(?:"[^"]*"|'[^']*')""", start_tag)
+	if match:
+		return start_tag[:match.start()] + attribute + start_tag[match.end():]
+	name_end = regex.match(r"<[^\s/>]+", start_tag).end()
+	return start_tag[:name_end] + " " + attribute + start_tag[name_end:]
+
+
+def process_file_head(filepath: str, parser: str = "html.parser", output: bool = True, context: SpineContext = None) -> (str, str, TitleInfo):
+	"""
+	Fast alternative to process_file(): parse only as far as the end of the first heading,
+	and patch the <title> contents, the heading and the section id directly into the original text.
+	The rest of the file is neither tree-built nor reformatted, so this assumes the file
+	has already been formatted (eg by `se clean`).
+
+	INPUTS:
+	filepath: path to content file
+	parser: parsing engine to use for the heading, one of the keys of PARSERS
+	output: if False, only analyse the heading and don't produce the altered text
+	context: the heading's enclosing elements from the spine index, if known
+
+	OUTPUTS:
+	altered xhtml file text (None if output is False), new section ID and title information (as a tuple)
+	"""
+	profile_file(filepath)
+	xhtml, locator, heading = read_head(filepath, parser)
+	if not heading:
+		# failure, so return blanks
+		return "", "", None
+	spans = heading.find_all("span", recursive=False)
+	original_spans = [span.decode_contents() for span in spans]
+	title_info, new_id = retitle_heading(heading, context)
+	if not output:
+		return None, new_id, title_info
+	with timed("splice"):
+		out_xhtml = splice_changes(xhtml, locator, title_info, new_id, spans, original_spans)
+	if out_xhtml is None:
+		print("Could not locate the heading spans in " + filepath)
+		return "", "", None
+	return out_xhtml, new_id, title_info
+
+
+def read_head(filepath: str, parser: str = "html.parser") -> tuple:
+	"""
+	Read a content file and parse just its first heading, in the context of its enclosing elements.
+
+	INPUTS:
+	filepath: path to content file
+	parser: parsing engine to use for the heading, one of the keys of PARSERS
+
+	OUTPUTS:
+	the file's text, a HeadLocator which has read it as far as the first heading and the parsed heading tag
+	(as a tuple); the locator and heading are None if the file has no h2-h6 heading
+	"""
+	with timed("gethtml"):
+		xhtml = gethtml(filepath)
+	with timed("locate_head"):
+		locator = locate_head(xhtml)
+	if not locator:
+		return xhtml, None, None
+	with timed("parse"):
+		soup = parse_xhtml(locator.context_markup(), parser, filepath)
+		heading = soup.find(HEADING_TAGS)
+	return xhtml, locator, heading
+
+
+def check_file(filepath: str, parser: str = "html.parser", context: SpineContext = None) -> (str, TitleInfo, list):
+	"""
+	Check, without changing anything, that a content file's <title>, first heading and section ID
+	are already what titler would make them. Only the head of the file is read, as with process_file_head().
+
+	INPUTS:
+	filepath: path to content file
+	parser: parsing engine to use for the heading, one of the keys of PARSERS
+	context: the heading's enclosing elements from the spine index, if known
+
+	OUTPUTS:
+	new section ID, title information and a list of descriptions of what is wrong (as a tuple);
+	the title information is None if the file has no heading to check
+	"""
+	profile_file(filepath)
+	xhtml, locator, heading = read_head(filepath, parser)
+	if not heading:
+		return "", None, []
+	spans = heading.find_all("span", recursive=False)
+	original_spans = [span.decode_contents() for span in spans]
+	title_info, new_id = retitle_heading(heading, context)
+	problems = []
+	title_tag = title_info.output_title_tag()
+	if locator.title_end < 0:
+		problems.append("no <title>, expected '" + title_tag + "'")
+	else:
+		old_title = html.unescape(xhtml[locator.title_start:locator.title_end])
+		if old_title != title_tag:
+			problems.append("<title> is '" + old_title + "', expected '" + title_tag + "'")
+	sections = [ancestor for ancestor in locator.ancestors if ancestor[0] == "section"]
+	if sections:
+		old_id = sections[-1][3].get("id") or ""
+		if old_id != new_id:
+			problems.append("section id is '" + old_id + "', expected '" + new_id + "'")
+	for index, span in enumerate(spans):
+		contents = span.decode_contents()
+		if contents != original_spans[index]:
+			problems.append("heading span " + str(index + 1) + " is '" + original_spans[index] + "', expected '" + contents + "'")
+	return new_id, title_info, problems
+
+
+def check_files(file_paths: list, jobs: int = 1, parser: str = "html.parser", fail_fast: bool = False, pool=None, contexts: list = None) -> list:
+	"""
+	Run check_file() over a list of content files, optionally spread across a process pool.
+
+	INPUTS:
+	file_paths: paths to content files, in spine order
+	jobs: number of worker processes; 1 checks the files serially
+	parser: parsing engine to use, one of the keys of PARSERS
+	fail_fast: stop at the first file (in spine order) which fails its check
+	pool: a process pool from start_pool() to use instead of starting one for these files;
+	it is terminated if fail_fast stops the check early
+	contexts: SpineContext of each file from build_spine_index(), if known
+
+	OUTPUTS:
+	list of check_file() results, in the same order as file_paths, ending at the first failure if fail_fast is set
+	"""
+	worker = functools.partial(check_file, parser=parser)
+	tasks = list(zip(file_paths, contexts or [None] * len(file_paths)))
+	if pool is None:
+		if jobs > 1 and len(file_paths) > 1:
+			with start_pool(min(jobs, len(file_paths))) as pool:
+				return check_files(file_paths, jobs, parser, fail_fast, pool, contexts)
+		results = []
+		for file_path, context in tasks:
+			results.append(worker(file_path, context=context))
+			if fail_fast and results[-1][2]:
+				break
+		return results
+	results = []
+	for result, reports, records in pool.imap(functools.partial(run_in_worker, worker), tasks):
+		for name, report in reports.items():
+			CACHES[name].merge_report(report)
+		if PROFILER:
+			PROFILER.records.extend(records)
+		results.append(result)
+		if fail_fast and result[2]:
+			# abandon the files still being checked
+			pool.terminate()
+			break
+	return results
+
+
+def splice_changes(xhtml: str, locator: HeadLocator, title_info: TitleInfo, new_id: str, spans: list, original_spans: list) -> str:
+	"""
+	Patch a new <title>, section id and heading span contents into the original text of a file.
+
+	INPUTS:
+	xhtml: original text of the file
+	locator: HeadLocator which has read the text as far as the first heading
+	title_info: title information for the heading
+	new_id: new section ID
+	spans: span tags directly inside the processed heading
+	original_spans: contents of those spans before the heading was processed
+
+	OUTPUTS:
+	altered xhtml file text, or None if the spans could not be matched up with the original text
+	"""
+	edits = []
+	if locator.title_end >= 0:
+		edits.append((locator.title_start, locator.title_end, html.escape(title_info.output_title_tag(), quote=False)))
+	sections = [ancestor for ancestor in locator.ancestors if ancestor[0] == "section"]
+	if sections:
+		name, start, start_tag, attributes = sections[-1]  # the innermost section, as find_parent() gives
+		edits.append((start, start + len(start_tag), set_id_attribute(start_tag, new_id)))
+	# only the contents of spans directly inside the heading are ever rewritten,
+	# so patch just those to keep the heading's own layout
+	for index, span in enumerate(spans):
+		contents = span.decode_contents()
+		if contents != original_spans[index]:
+			if len(spans) != len(locator.spans) or locator.spans[index][1] < 0:
+				return None
+			edits.append((locator.spans[index][0], locator.spans[index][1], contents))
+	return splice_text(xhtml, edits)
+
+
+class ContextElement(dict):
+	"""
+	Attributes of an element enclosing a heading, as recorded by the spine index.
+	Stands in for the element's Beautiful Soup tag: it has a name, and its attributes can be read with get().
+	"""
+	def __init__(self, name: str, attributes: dict, ordinal: int = 0):
+		"""
+		:param name: element name, eg 'section'
+		:param attributes: the element's attributes
+		:param ordinal: for a part, division or volume, its number among those of its kind in spine order, from 1
+		"""
+		super().__init__(attributes)
+		self.name = name
+		self.ordinal = ordinal
+
+
+class SpineContext:
+	"""
+	The elements enclosing the first heading of a content file, innermost first.
+	Answers find_parents() as the heading's tag would, without a parsed tree.
+	"""
+	def __init__(self, elements: list):
+		self.elements = elements
+
+	def find_parents(self, names) -> list:
+		"""
+		:param names: an element name, or a list of them
+		:return: the enclosing elements with those names, innermost first
+		"""
+		if isinstance(names, str):
+			names = [names]
+		return [element for element in self.elements if element.name in names]
+
+
+def file_context(filepath: str) -> SpineContext:
+	"""
+	Find the elements enclosing the first heading of a file, reading only as far as the heading.
+	:param filepath: path to content file
+	:return: the file's SpineContext, or None if it has no h2-h6 heading
+	"""
+	locator = locate_head(gethtml(filepath))
+	if not locator:
+		return None
+	return SpineContext([ContextElement(name, attributes) for name, start, start_tag, attributes in reversed(locator.ancestors)])
+
+
+def build_spine_index(textpath: str, spine: list) -> dict:
+	"""
+	Find the enclosing elements of the first heading of every file in the spine, in one pass,
+	numbering the parts, divisions and volumes in spine order as they're met.
+
+	INPUTS:
+	textpath: directory holding the content files
+	spine: names of the spine files, in spine order
+
+	OUTPUTS:
+	dict mapping file name to SpineContext, for each file with a heading
+	"""
+	index = {}
+	for file_name in spine:
+		context = file_context(os.path.join(textpath, file_name))
+		if context is not None:
+			index[file_name] = context
+	number_divisions(index, spine)
+	return index
+
+
+def refresh_spine_index(index: dict, textpath: str, spine: list, file_names) -> set:
+	"""
+	Bring a spine index up to date after some files have changed, reading only those files, then renumber its divisions.
+
+	INPUTS:
+	index: dict mapping file name to SpineContext, from build_spine_index(); updated in place
+	textpath: directory holding the content files
+	spine: names of the spine files, in spine order, which may have changed since the index was built
+	file_names: names of the files to read again
+
+	OUTPUTS:
+	set of the names of files whose part, division or volume numbers are no longer what they were
+	"""
+	before = {file_name: [element.ordinal for element in context.elements] for file_name, context in index.items()}
+	for file_name in set(index) - set(spine):
+		del index[file_name]
+	for file_name in file_names:
+		context = file_context(os.path.join(textpath, file_name))
+		if context is None:
+			index.pop(file_name, None)
+		else:
+			index[file_name] = context
+	number_divisions(index, spine)
+	return {file_name for file_name, context in index.items() if [element.ordinal for element in context.elements] != before.get(file_name)}
+
+
+def number_divisions(index: dict, spine: list):
+	"""
+	Number the parts, divisions and volumes in a spine index by their place in the spine, not by their ids,
+	which titler itself may rewrite: a title page (a file whose heading's own section is the division) starts a new one,
+	and the files after it that are wrapped in a section of the same kind belong to it, whatever that wrapper's id.
+	Without a title page, a new one starts wherever the wrapper's id changes.
+
+	INPUTS:
+	index: dict mapping file name to SpineContext, whose ContextElements' ordinals are set
+	spine: names of the spine files, in spine order
+	"""
+	counts = {division: 0 for division in ENCLOSING_DIVISIONS}
+	current_ids = {division: "" for division in ENCLOSING_DIVISIONS}  # None just after a title page
+	for file_name in spine:
+		context = index.get(file_name)
+		if context is None:
+			continue
+		enclosing = context.find_parents(["section", "article"])
+		for element in reversed(enclosing):
+			element.ordinal = 0
+			kind = classify_epub_type(element.get("epub:type") or "")[0]
+			if kind not in counts:
+				continue
+			section_id = element.get("id") or ""
+			if element is enclosing[0]:
+				counts[kind] += 1
+				current_ids[kind] = None
+			elif current_ids[kind] is None:
+				current_ids[kind] = section_id
+			elif section_id != current_ids[kind]:
+				counts[kind] += 1
+				current_ids[kind] = section_id
+			element.ordinal = counts[kind]
+
+
+def get_book_division(tag: bs4.BeautifulSoup) -> (BookDivision, str):
+	"""
+	Determine and return the kind of book division, and the prefix for its titles and ids.
+	At present only Chapter, Part, Division and Volume are important;
+	but others stored for possible future logic.
+	tag may also be the SpineContext of the tag's file.
+	"""
+	parent_section = tag.find_parents(["section", "article"])
+	if not parent_section:
+		parent_section = tag.find_parents("body")
+	if not parent_section:
+		return BookDivision.NONE, ""
+	division, prefix = classify_epub_type(parent_section[0].get("epub:type") or "")
+	if division == BookDivision.NONE and parent_section[0].name == "article":
+		return BookDivision.ARTICLE, ""
+	return division, prefix
+
+
+# don't process these files
+EXCLUDE_LIST = ["titlepage.xhtml", "colophon.xhtml", "uncopyright.xhtml", "imprint.xhtml", "halftitle.xhtml", "dedication.xhtml", "endnotes.xhtml", "loi.xhtml"]
+
+
+def process_files(file_paths: list, jobs: int = 1, parser: str = "html.parser", fast: bool = False, format_mode: str = "always", pool=None, output: bool = True, contexts: list = None) -> list:
+	"""
+	Run process_file() over a list of content files, optionally spread across a process pool.
+
+	INPUTS:
+	file_paths: paths to content files, in spine order
+	jobs: number of worker processes; 1 processes the files serially
+	parser: parsing engine to use, one of the keys of PARSERS
+	fast: use process_file_head() instead of process_file()
+	format_mode: how process_file() produces its output, one of FORMAT_MODES
+	pool: a process pool from start_pool() to use instead of starting one for these files
+	output: if False, only analyse the headings and don't produce the altered text
+	contexts: SpineContext of each file from build_spine_index(), if known
+
+	OUTPUTS:
+	list of process_file() results, in the same order as file_paths
+	"""
+	if fast:
+		worker = functools.partial(process_file_head, parser=parser, output=output)
+	else:
+		worker = functools.partial(process_file, parser=parser, format_mode=format_mode, output=output)
+	tasks = list(zip(file_paths, contexts or [None] * len(file_paths)))
+	if pool is None:
+		if jobs > 1 and len(file_paths) > 1:
+			with start_pool(min(jobs, len(file_paths))) as pool:
+				return process_files(file_paths, jobs, parser, fast, format_mode, pool, output, contexts)
+		return [worker(file_path, context=context) for file_path, context in tasks]
+	outcomes = pool.map(functools.partial(run_in_worker, worker), tasks)
+	results = []
+	for result, reports, records in outcomes:
+		for name, report in reports.items():
+			CACHES[name].merge_report(report)
+		if PROFILER:
+			PROFILER.records.extend(records)
+		results.append(result)
+	return results
+
+
+def process_files_in_chunks(file_paths: list, chunk_size: int, jobs: int = 1, parser: str = "html.parser", fast: bool = False, format_mode: str = "always", pool=None, output: bool = True, contexts: list = None):
+	"""
+	Generator alternative to process_files() for --memory-budget, which works through the files a chunk at a time,
+	so that only one chunk's results are held in memory at once. Takes the same arguments, plus:
+	chunk_size: number of files in each chunk
+	"""
+	contexts = contexts or [None] * len(file_paths)
+	for start in range(0, len(file_paths), chunk_size):
+		yield from process_files(file_paths[start:start + chunk_size], jobs, parser, fast, format_mode, pool, output, contexts[start:start + chunk_size])
+
+
+# rough peak memory of a process with bs4 and se.formatting loaded (measured at about 34 MiB)
+PROCESS_BASELINE = 40 * MIB
+# rough peak memory while parsing and reformatting a whole file, per byte of its text
+TREE_MEMORY_FACTOR = 60
+# rough peak memory when only the head of a file is parsed (--fast, --check), per byte of its text
+HEAD_MEMORY_FACTOR = 3
+# files per worker in each chunk processed under --memory-budget
+MEMORY_CHUNK_FILES = 4
+
+
+def jobs_within_budget(jobs: int, budget: int, directories: list, head_only: bool = False) -> int:
+	"""
+	Cap the number of worker processes so that their estimated peak memory, with the main process's, fits a budget.
+	The estimate allows for every worker parsing a file as big as the largest in the projects at once.
+
+	INPUTS:
+	jobs: number of worker processes asked for
+	budget: memory budget in bytes
+	directories: Standard Ebooks root directories
+	head_only: whether only the heads of files will be parsed
+
+	OUTPUTS:
+	number of jobs to use, at least 1
+	"""
+	largest = 0
+	for rootpath in directories:
+		try:
+			with os.scandir(os.path.join(rootpath, 'src', 'epub', 'text')) as entries:
+				largest = max([largest] + [entry.stat().st_size for entry in entries if entry.name.endswith(".xhtml")])
+		except OSError:
+			continue  # reported when the project is processed
+	per_process = PROCESS_BASELINE + largest * (HEAD_MEMORY_FACTOR if head_only else TREE_MEMORY_FACTOR)
+	# with workers, the main process only collects and writes their output
+	capped = max(1, min(jobs, (budget - PROCESS_BASELINE) // per_process))
+	if per_process > budget:
+		print("Warning: processing the largest file may take about {:.0f} MiB, more than the memory budget".format(per_process / MIB))
+	elif capped < jobs:
+		print("Memory budget allows " + str(capped) + " of the " + str(jobs) + " jobs asked for")
+	return capped
+
+
+def start_pool(jobs: int):
+	"""
+	Start a pool of worker processes, seeded with the main process's cache entries.
+	:param jobs: number of worker processes
+	:return: the pool, to use with process_files()
+	"""
+	seed = {name: dict(cache.entries) for name, cache in CACHES.items()}
+	import multiprocessing
+	return multiprocessing.Pool(jobs, initializer=init_worker, initargs=(seed, PROFILER is not None, DIVISION_TABLE))
+
+
+def init_worker(seed: dict, profile: bool = False, divisions: list = None):
+	"""
+	Set up a worker process: start its caches from the main process's entries, and collect new ones.
+	:param seed: cached entries, by cache name
+	:param profile: whether to collect timings for --profile
+	:param divisions: the main process's DIVISION_TABLE, which may have been extended
+	"""
+	global PROFILER
+	extend_division_table(divisions or [])
+	for name, cache in CACHES.items():
+		for text, result in seed.get(name, {}).items():
+			cache.put(text, result)
+		cache.take_report()
+	PROFILER = Profiler() if profile else None
+
+
+def run_in_worker(worker, task: tuple) -> tuple:
+	"""
+	Process one file in a worker process.
+	:param worker: function to call with the file's path and context
+	:param task: path to the content file and its SpineContext (or None)
+	:return: the worker's result, the cache reports to merge into the main process, and any profiler records
+	"""
+	file_path, context = task
+	result = worker(file_path, context=context)
+	records = PROFILER.take_records() if PROFILER else []
+	return result, {name: cache.take_report() for name, cache in CACHES.items()}, records
+
+
+def title_record(file_name: str, new_id: str, title_info: TitleInfo) -> dict:
+	"""
+	:return: dict describing the title computed for a file, for --emit
+	"""
+	return {
+		"file": file_name,
+		"division": title_info.division.name.lower(),
+		"title": title_info.title,
+		"subtitle": title_info.subtitle,
+		"number": title_info.number,
+		"roman": title_info.roman,
+		"id_prefix": title_info.id_prefix,
+		"new_id": new_id,
+		"title_tag": title_info.output_title_tag()
+	}
+
+
+class RecordEmitter:
+	"""
+	Writes title records for --emit, either as a stream of JSON lines ("ndjson")
+	or as a single JSON array written once all the records are in ("json")
+	"""
+	def __init__(self, output_format: str, stream):
+		self.output_format = output_format
+		self.stream = stream
+		self.records = []
+
+	def emit(self, record: dict):
+		if self.output_format == "ndjson":
+			self.stream.write(json.dumps(record, ensure_ascii=False) + "\n")
+			self.stream.flush()
+		else:
+			self.records.append(record)
+
+	def close(self):
+		if self.output_format == "json":
+			json.dump(self.records, self.stream, ensure_ascii=False, indent=1)
+			self.stream.write("\n")
+		self.stream.flush()
+
+
+def read_spine(opfpath: str) -> list:
+	"""
+	:param opfpath: path to content.opf
+	:return: the content files in the spine, less those in EXCLUDE_LIST
+	"""
+	with timed("read_spine"):
+		xhtml = gethtml(opfpath)
+		soup = bs4.BeautifulSoup(xhtml, "lxml")
+		file_list = [file_name for file_name in get_content_files(soup) if file_name not in EXCLUDE_LIST]
+		soup.decompose()
+		return file_list
+
+
+def process_project(rootpath: str, args, pool=None, label: str = "", only: set = None, emitter: RecordEmitter = None, spine: list = None, spine_index: dict = None) -> dict:
+	"""
+	Process all the content files of one Standard Ebooks project.
+
+	INPUTS:
+	rootpath: Standard Ebooks root directory
+	args: parsed command-line arguments
+	pool: process pool from start_pool() to share between projects, or None to work serially
+	label: prefix for the messages printed about this project
+	only: if given, process only the spine files with these names
+	emitter: if given, a title record for each file processed is passed to it
+	spine: the spine files, if already read (eg by --watch); otherwise content.opf is read
+	spine_index: the SpineContexts of the whole spine from build_spine_index(), if already built;
+		otherwise the spine is indexed afresh
+
+	OUTPUTS:
+	dict of counts of the files in the spine, and those processed, skipped, written and unchanged,
+	plus the paths of the files written; None if rootpath is not a Standard Ebooks root directory
+	"""
+	opfpath = os.path.join(rootpath, 'src', 'epub', 'content.opf')
+	textpath = os.path.join(rootpath, 'src', 'epub', 'text')
+
+	if not os.path.exists(opfpath):
+		print(label + "Error: this does not seem to be a Standard Ebooks root directory")
+		return None
+
+	file_list = read_spine(opfpath) if spine is None else list(spine)
+	spine = list(file_list)
+	spine_count = len(file_list)
+	# the whole spine is indexed, even if only some files are processed, so that parts are numbered the same way every time
+	if spine_index is None:
+		with timed("spine_index"):
+			spine_index = build_spine_index(textpath, file_list)
+	if only is not None:
+		file_list = [file_name for file_name in file_list if file_name in only]
+
+	if args.check:
+		return check_project(rootpath, file_list, spine_count, args, pool, label, emitter, spine_index)
+
+	manifest = {}
+	skipped = 0
+	if args.incremental:
+		options = manifest_options(args)
+		manifest = load_manifest(rootpath, options)
+		changed_list = []
+		for file_name in file_list:
+			file_path = os.path.join(textpath, file_name)
+			# a file whose text still hashes to titler's last output for it, in the same place in the book, has nothing to do
+			if manifest.get(os.path.relpath(file_path, rootpath)) != manifest_entry(content_hash(gethtml(file_path)), spine_index.get(file_name)):
+				changed_list.append(file_name)
+		skipped = len(file_list) - len(changed_list)
+		file_list = changed_list
+
+	# workers only compute results; all writing happens here, in spine order
+	format_mode = args.format_mode
+	file_paths = [os.path.join(textpath, file_name) for file_name in file_list]
+	contexts = [spine_index.get(file_name) for file_name in file_list]
+	if args.memory_budget and not args.rename:
+		# write each chunk's output before working on the next, rather than holding the whole book's;
+		# renaming needs every result up front, to plan the renames
+		results = process_files_in_chunks(file_paths, args.jobs * MEMORY_CHUNK_FILES, args.jobs, args.parser, args.fast, format_mode, pool, not args.no_write, contexts)
+	else:
+		results = process_files(file_paths, args.jobs, args.parser, args.fast, format_mode, pool, not args.no_write, contexts)
+	renames = {}
+	references = {}
+	if args.rename and not args.no_write:
+		renames = plan_renames(file_list, results, textpath, label)
+		if renames:
+			pattern = reference_pattern(renames)
+			with timed("index_references"):
+				references = index_references(rootpath, pattern)
+	# renamed files and the references to them have to change together, so always go through a batch
+	batch = WriteBatch(sync_files=args.fsync == "file") if args.atomic or renames else None
+	handled = set()
+	output_hashes = {}  # content_hash() of the output for each file name, for the manifest
+	failed = False
+	processed = 0
+	written_paths = []
+	unchanged = 0
+	would_change = 0
+	for file_name, result in zip(file_list, results):
+		if result[2] is not None:
+			out_xhtml = result[0]
+			processed += 1
+			if emitter:
+				record = title_record(file_name, result[1], result[2])
+				record["project"] = rootpath
+				emitter.emit(record)
+			if args.no_write:
+				continue
+			# if args.in_place:
+			# 	puthtml(out_xhtml, os.path.join(textpath, file_name))
+			if args.rename:
+				if result[1] != "":
+					out_path = os.path.join(textpath, renames.get(file_name, file_name))
 				else:
-					print("This should throw an error: empty rename string")
+					print(label + "This should throw an error: empty rename string")
+					continue
 			else:
 				# print(out_xhtml)
-				puthtml(out_xhtml, os.path.join(textpath, file_name))
-	if processed == 0:
-		print("This should throw a warning: No files processed. Did you update manifest and order the spine?")
+				out_path = os.path.join(textpath, file_name)
+			if args.dry_run:
+				in_path = os.path.join(textpath, file_name)
+				# spliced output only differs within the head of the file; reformatted output can differ anywhere
+				diff_function = head_diff if args.fast or format_mode == "splice" else file_diff
+				diff = diff_function(gethtml(in_path), out_xhtml, os.path.relpath(in_path, rootpath))
+				if out_path != in_path:
+					print("Would write " + os.path.relpath(in_path, rootpath) + " as " + os.path.relpath(out_path, rootpath))
+				if diff or out_path != in_path:
+					would_change += 1
+					print(diff, end="")
+				continue
+			if renames:
+				out_xhtml = rewrite_references(out_xhtml, pattern, renames)
+			handled.add(os.path.join(textpath, file_name))
+			profile_file(out_path)
+			with timed("puthtml"):
+				put_result = batch.stage(out_xhtml, out_path, os.path.join(textpath, file_name)) if batch else puthtml(out_xhtml, out_path)
+			if put_result is None:
+				if batch:
+					failed = True
+					break
+				continue
+			if put_result:
+				written_paths.append(out_path)
+			else:
+				unchanged += 1
+			if args.incremental:
+				output_hashes[os.path.basename(out_path)] = content_hash(out_xhtml)
+	updated = []  # other files whose references to renamed files are rewritten
+	if args.dry_run:
+		for path in sorted(set(references) - {os.path.join(textpath, file_name) for file_name in file_list}):
+			print("Would update references in " + os.path.relpath(path, rootpath))
+	elif renames and not failed:
+		for path, text in references.items():
+			if path in handled:
+				continue  # already rewritten along with its new title
+			put_result = batch.stage(rewrite_references(text, pattern, renames), path)
+			if put_result is None:
+				failed = True
+				break
+			if put_result:
+				updated.append(path)
+	if batch:
+		with timed("commit"):
+			failed = failed or not batch.commit()
+		if failed:
+			batch.rollback()
+			print(label + "Error: could not write every file, so no files were changed")
+			return {"spine": spine_count, "processed": processed, "skipped": skipped, "written": 0, "unchanged": unchanged, "renamed": 0, "written_paths": [], "failed": True}
+	if renames and not args.dry_run:
+		for old_name in renames:
+			# a file renamed to the old name of another has already taken its place
+			if old_name not in renames.values():
+				os.remove(os.path.join(textpath, old_name))
+				manifest.pop(os.path.relpath(os.path.join(textpath, old_name), rootpath), None)
+		written_paths.extend(updated)
+	if args.incremental and not (args.no_write or args.dry_run):
+		# record the parts' numbers as the next run will find them, from the section ids just written
+		with timed("spine_index"):
+			if renames:
+				spine_index = build_spine_index(textpath, read_spine(opfpath))
+			else:
+				refresh_spine_index(spine_index, textpath, spine, output_hashes)
+		for file_name, text_hash in output_hashes.items():
+			manifest[os.path.relpath(os.path.join(textpath, file_name), rootpath)] = manifest_entry(text_hash, spine_index.get(file_name))
+		save_manifest(rootpath, manifest, options)
+	if args.cache and not args.dry_run:
+		save_caches(rootpath)
+	if processed == 0 and skipped == 0:
+		print(label + "This should throw a warning: No files processed. Did you update manifest and order the spine?")
+	elif args.dry_run:
+		print(label + "Would change " + str(would_change) + " of " + str(spine_count) + " files")
+	else:
+		print(label + "Processed " + str(processed) + " of " + str(spine_count) + " files" + (", skipped " + str(skipped) + " unchanged since last run" if args.incremental else ""))
+		print(label + "Written: " + str(len(written_paths)) + ", unchanged: " + str(unchanged))
+		if renames:
+			print(label + "Renamed: " + str(len(renames)) + ", references updated in " + str(len(updated)) + " other files")
+	return {"spine": spine_count, "processed": processed, "skipped": skipped, "written": len(written_paths), "unchanged": unchanged, "renamed": 0 if args.dry_run else len(renames), "would_change": would_change, "written_paths": written_paths}
+
+
+# files in which references to renamed content files are looked for
+REFERENCE_EXTENSIONS = (".xhtml", ".opf", ".ncx")
+
+
+def plan_renames(file_list: list, results: list, textpath: str, label: str = "") -> dict:
+	"""
+	Work out which content files --rename will rename, leaving out any whose new name would clash
+	with another file's.
+
+	INPUTS:
+	file_list: names of the spine files processed, in spine order
+	results: their process_file() results
+	textpath: directory holding the content files
+	label: prefix for the messages printed about clashes
+
+	OUTPUTS:
+	dict mapping old file name to new file name, for each file to be renamed
+	"""
+	wanted = {}
+	for file_name, result in zip(file_list, results):
+		if result[2] is not None and result[1] and result[1] + ".xhtml" != file_name:
+			wanted[file_name] = result[1] + ".xhtml"
+	targets = collections.Counter(wanted.values())
+	renames = {}
+	for old_name, new_name in wanted.items():
+		if targets[new_name] > 1:
+			print(label + "Error: more than one file would be renamed " + new_name + ", so " + old_name + " keeps its name")
+		else:
+			renames[old_name] = new_name
+	# a new name may only be an existing file's if that file is itself renamed away;
+	# dropping one rename can leave another clashing, so repeat until none do
+	clashing = True
+	while clashing:
+		clashing = [old_name for old_name, new_name in renames.items() if new_name not in renames and os.path.exists(os.path.join(textpath, new_name))]
+		for old_name in clashing:
+			print(label + "Error: " + renames.pop(old_name) + " already exists, so " + old_name + " keeps its name")
+	return renames
+
+
+def reference_pattern(renames: dict):
+	"""
+	:param renames: dict mapping old file name to new file name
+	:return: compiled regex matching any of the old names where it is used as (the end of) a path or an id,
+	ie after a quote or slash and before a quote or fragment
+	"""
+	# longest first, so that no name matches just the end of a longer one
+	names = sorted(renames, key=len, reverse=True)
+	return regex.compile(r'(?<=["/])(?:' + "|".join(regex.escape(name) for name in names) + r')(?=["#])')
+
+
+def index_references(rootpath: str, pattern) -> dict:
+	"""
+	Scan the whole epub once for references to renamed files.
+
+	INPUTS:
+	rootpath: Standard Ebooks root directory
+	pattern: regex from reference_pattern()
+
+	OUTPUTS:
+	dict mapping the path of each file containing a reference to its text
+	"""
+	references = {}
+	for dirpath, dirnames, filenames in os.walk(os.path.join(rootpath, 'src', 'epub')):
+		for filename in filenames:
+			if filename.endswith(REFERENCE_EXTENSIONS):
+				path = os.path.join(dirpath, filename)
+				text = gethtml(path)
+				if pattern.search(text):
+					references[path] = text
+	return references
+
+
+def rewrite_references(text: str, pattern, renames: dict) -> str:
+	"""
+	Replace every reference to a renamed file in some text.
+
+	INPUTS:
+	text: text of a file
+	pattern: regex from reference_pattern()
+	renames: dict mapping old file name to new file name
+
+	OUTPUTS:
+	the text, referring to the new file names
+	"""
+	return pattern.sub(lambda match: renames[match.group()], text)
+
+
+def check_project(rootpath: str, file_list: list, spine_count: int, args, pool=None, label: str = "", emitter: RecordEmitter = None, spine_index: dict = None) -> dict:
+	"""
+	Check the content files of one Standard Ebooks project, for --check, and print what is wrong with each.
+
+	INPUTS:
+	rootpath: Standard Ebooks root directory
+	file_list: names of the spine files to check, in spine order
+	spine_count: number of files in the spine
+	args: parsed command-line arguments
+	pool: process pool from start_pool() to share between projects, or None to work serially
+	label: prefix for the messages printed about this project
+	emitter: if given, a title record for each file checked is passed to it
+	spine_index: SpineContexts from build_spine_index(), by file name
+
+	OUTPUTS:
+	dict of counts of the files in the spine, and those checked and failing the check
+	"""
+	textpath = os.path.join(rootpath, 'src', 'epub', 'text')
+	contexts = [(spine_index or {}).get(file_name) for file_name in file_list]
+	results = check_files([os.path.join(textpath, file_name) for file_name in file_list], args.jobs, args.parser, args.fail_fast, pool, contexts)
+	processed = 0
+	failures = 0
+	for file_name, (new_id, title_info, problems) in zip(file_list, results):
+		if title_info is None:
+			continue
+		processed += 1
+		if emitter:
+			record = title_record(file_name, new_id, title_info)
+			record["project"] = rootpath
+			emitter.emit(record)
+		if problems:
+			failures += 1
+			for problem in problems:
+				print(label + os.path.relpath(os.path.join(textpath, file_name), rootpath) + ": " + problem)
+	# a check writes nothing, not even the cache; one loaded with --cache is still used
+	if failures and args.fail_fast:
+		print(label + "Stopped at the first file that failed the check")
+	else:
+		print(label + "Checked " + str(processed) + " of " + str(spine_count) + " files, " + str(failures) + " failed")
+	return {"spine": spine_count, "processed": processed, "skipped": 0, "written": 0, "unchanged": 0, "would_change": 0, "failures": failures, "written_paths": []}
+
+
+def head_diff(original: str, new_text: str, filename: str) -> str:
+	"""
+	Unified diff of a file's text up to the end of its first heading, where all of a spliced output's changes lie;
+	the rest of the file is never compared.
+
+	INPUTS:
+	original: the file's current text
+	new_text: the file's spliced output
+	filename: name to show in the diff headers
+
+	OUTPUTS:
+	the diff, or "" if nothing changed
+	"""
+	locator = locate_head(original)
+	if locator is None:
+		return ""
+	# extend to the end of the heading's line, so both sides end with a whole line
+	head_end = original.find("\n", locator.heading_end)
+	head_end = len(original) if head_end < 0 else head_end + 1
+	tail_length = len(original) - head_end
+	old_lines = original[:head_end].splitlines(True)
+	new_lines = new_text[:len(new_text) - tail_length].splitlines(True)
+	return "".join(difflib.unified_diff(old_lines, new_lines, "a/" + filename, "b/" + filename))
+
+
+def file_diff(original: str, new_text: str, filename: str) -> str:
+	"""
+	Unified diff of the whole of a file's text, for output that has been reformatted
+
+	INPUTS:
+	original: the file's current text
+	new_text: the file's new text
+	filename: name to show in the diff headers
+
+	OUTPUTS:
+	the diff, or "" if nothing changed
+	"""
+	return "".join(difflib.unified_diff(original.splitlines(True), new_text.splitlines(True), "a/" + filename, "b/" + filename))
+
+
+def snapshot_project(rootpath: str) -> dict:
+	"""
+	:param rootpath: Standard Ebooks root directory
+	:return: dict mapping the paths of content.opf and the text files to their (mtime, size)
+	"""
+	snapshot = {}
+	opfpath = os.path.join(rootpath, 'src', 'epub', 'content.opf')
+	textpath = os.path.join(rootpath, 'src', 'epub', 'text')
+	paths = [opfpath]
+	if os.path.isdir(textpath):
+		paths.extend(entry.path for entry in os.scandir(textpath) if entry.name.endswith(".xhtml"))
+	for path in paths:
+		try:
+			stat = os.stat(path)
+		except OSError:
+			continue
+		snapshot[path] = (stat.st_mtime_ns, stat.st_size)
+	return snapshot
+
+
+def division_ids(context: SpineContext) -> tuple:
+	"""
+	Find which sections enclose the first heading of a file, for working out which files depend on which parts.
+	:param context: the file's SpineContext from the spine index, or None if it has no heading
+	:return: tuple of the file's own (innermost) section id, and the set of ids of the outer sections wrapping it
+	"""
+	if not context:
+		return "", set()
+	ids = [element.get("id") or "" for element in context.find_parents(["section", "article"])]
+	if not ids:
+		return "", set()
+	return ids[0], set(ids[1:])
+
+
+def wait_for_changes(watcher, interval: float):
+	"""
+	Block until something may have changed: an inotify event arrives, or the polling interval passes.
+	:param watcher: an inotify_simple.INotify, or None to poll
+	:param interval: polling interval in seconds
+	"""
+	if watcher is None:
+		time.sleep(interval)
+		return
+	if watcher.read(timeout=int(interval * 1000)):
+		# let a burst of events (eg an editor's save) settle, then drain it
+		time.sleep(0.1)
+		watcher.read(timeout=0)
+
+
+def start_watcher(rootpath: str):
+	"""
+	Set up inotify watches on the project's text directory and content.opf, if inotify_simple is available.
+	:param rootpath: Standard Ebooks root directory
+	:return: an inotify_simple.INotify, or None if we have to fall back to polling
+	"""
+	try:
+		from inotify_simple import INotify, flags
+	except ImportError:
+		return None
+	try:
+		watcher = INotify()
+		watch_flags = flags.CLOSE_WRITE | flags.MOVED_TO | flags.CREATE | flags.DELETE | flags.MOVED_FROM
+		watcher.add_watch(os.path.join(rootpath, 'src', 'epub'), watch_flags)
+		watcher.add_watch(os.path.join(rootpath, 'src', 'epub', 'text'), watch_flags)
+	except OSError:
+		return None
+	return watcher
+
+
+def watch_project(rootpath: str, args, pool=None, emitter: RecordEmitter = None):
+	"""
+	Process a project, then keep reprocessing the files which change until interrupted.
+	Only changed files are reprocessed, plus any files nested in a part or volume whose own file changed
+	and any whose parts are renumbered; if content.opf changes, files new to the spine are processed too.
+
+	INPUTS:
+	rootpath: Standard Ebooks root directory
+	args: parsed command-line arguments
+	pool: process pool from start_pool(), or None to work serially
+	emitter: if given, title records for --emit are passed to it
+	"""
+	opfpath = os.path.join(rootpath, 'src', 'epub', 'content.opf')
+	textpath = os.path.join(rootpath, 'src', 'epub', 'text')
+	if not os.path.exists(opfpath):
+		process_project(rootpath, args, pool, emitter=emitter)  # reports that it isn't a project
+		return
+	# the spine index is kept from one change to the next, and only the files which change are read again
+	spine = read_spine(opfpath)
+	with timed("spine_index"):
+		spine_index = build_spine_index(textpath, spine)
+	summary = process_project(rootpath, args, pool, emitter=emitter, spine=spine, spine_index=spine_index)
+	if summary is None:
+		return
+	spine, spine_index = index_written_files(summary, opfpath, textpath, spine, spine_index)
+	snapshot = snapshot_project(rootpath)
+	watcher = start_watcher(rootpath)
+	print("Watching " + rootpath + (" with inotify" if watcher else " by polling every " + str(args.watch_interval) + " s") + "; press Ctrl-C to stop")
+	while True:
+		wait_for_changes(watcher, args.watch_interval)
+		current = snapshot_project(rootpath)
+		changed = {os.path.basename(path) for path in current if current[path] != snapshot.get(path) and path != opfpath}
+		spine_changed = current.get(opfpath) != snapshot.get(opfpath)
+		if spine_changed:
+			new_spine = read_spine(opfpath)
+			changed.update(set(new_spine) - set(spine))
+			spine = new_spine
+		snapshot = current
+		changed.intersection_update(spine)
+		if not changed and not spine_changed:
+			continue
+		old_ids = {file_name: division_ids(spine_index.get(file_name)) for file_name in changed}
+		with timed("spine_index"):
+			# files whose parts were renumbered, eg by a part added earlier in the spine, change too
+			renumbered = refresh_spine_index(spine_index, textpath, spine, changed)
+		# a changed part or volume file affects the files nested inside it
+		for file_name in list(changed):
+			for division_id in {old_ids[file_name][0], division_ids(spine_index.get(file_name))[0]} - {""}:
+				changed.update(other for other, context in spine_index.items() if division_id in division_ids(context)[1])
+		changed.update(renumbered)
+		if not changed:
+			continue
+		summary = process_project(rootpath, args, pool, only=changed, emitter=emitter, spine=spine, spine_index=spine_index)
+		if summary is None:
+			return
+		# don't treat our own writes as changes
+		for path in summary["written_paths"]:
+			stat = os.stat(path)
+			snapshot[path] = (stat.st_mtime_ns, stat.st_size)
+		spine, spine_index = index_written_files(summary, opfpath, textpath, spine, spine_index)
+
+
+def index_written_files(summary: dict, opfpath: str, textpath: str, spine: list, spine_index: dict) -> tuple:
+	"""
+	Bring --watch's spine and spine index up to date with the files process_project() has just written.
+
+	INPUTS:
+	summary: what process_project() returned
+	opfpath: path to content.opf
+	textpath: directory holding the content files
+	spine: names of the spine files, in spine order
+	spine_index: SpineContexts of the spine files, from build_spine_index(); updated in place
+
+	OUTPUTS:
+	the spine and spine index (as a tuple), both read afresh if files were renamed
+	"""
+	with timed("spine_index"):
+		if summary.get("renamed"):
+			spine = read_spine(opfpath)
+			return spine, build_spine_index(textpath, spine)
+		written = {os.path.basename(path) for path in summary["written_paths"] if os.path.dirname(path) == textpath}
+		refresh_spine_index(spine_index, textpath, spine, written & set(spine))
+	return spine, spine_index
+
+
+def read_directory_list(filename: str) -> list:
+	"""
+	Read a list of project directories, one per line; blank lines and lines starting with # are ignored.
+	:param filename: file to read, or "-" for standard input
+	:return: list of directories
+	"""
+	if filename == "-":
+		lines = sys.stdin.read().splitlines()
+	else:
+		lines = gethtml(filename).splitlines()
+	return [line.strip() for line in lines if line.strip() and not line.strip().startswith("#")]
+
+
+def main():
+	parser = argparse.ArgumentParser(description="Process titles and subtitles, set title case and update <title> tags.")
+# 	parser.add_argument("-i", "--in_place", action="store_true", help="overwrite the existing xhtml files instead of printing to stdout")
+	parser.add_argument("-r", "--rename", action="store_true", help="rename xhtml files for their new section ids, updating every reference to them in the epub")
+	parser.add_argument("-j", "--jobs", type=int, default=1, metavar="N", help="process files using N worker processes (default 1)")
+	parser.add_argument("--parser", choices=sorted(PARSERS), default="html.parser", help="parsing engine for content files (default html.parser)")
+	parser.add_argument("--format", choices=FORMAT_MODES, default="always", dest="format_mode", help="reformat every file (default), only files whose titles or ids changed, or splice the changes into the existing text")
+	parser.add_argument("--fast", action="store_true", help="only parse up to the first heading and splice the changes into the existing text (implies --format splice)")
+	parser.add_argument("--memory-budget", type=int, metavar="MB", help="keep estimated peak memory use within MB mebibytes, by running fewer jobs if need be and writing output as each small batch of files is done (except with --rename)")
+	parser.add_argument("--atomic", action="store_true", help="write all output to temporary files first, then rename them into place together, leaving the project untouched if any write fails")
+	parser.add_argument("--fsync", choices=["file", "dir"], default="file", help="with --atomic, fsync every file before renaming (default), or just the directory afterwards")
+	parser.add_argument("-n", "--dry-run", action="store_true", help="don't write anything; print a diff of the changes that would be made with the chosen --format, and exit with status 1 if there are any")
+	parser.add_argument("--check", action="store_true", help="don't write anything; check that every title, <title> tag and section id is already correct, and exit with status 1 if not")
+	parser.add_argument("--fail-fast", action="store_true", help="with --check, stop at the first file that fails")
+	parser.add_argument("--emit", choices=["json", "ndjson"], help="write the computed titles and ids of each file to standard output, as a JSON array or one JSON object per line; other messages go to standard error")
+	parser.add_argument("--no-write", action="store_true", help="don't produce or write any xhtml; useful with --emit")
+	parser.add_argument("--incremental", action="store_true", help="skip files unchanged since titler last wrote them (uses " + MANIFEST_NAME + " in the project root)")
+	parser.add_argument("--cache", action="store_true", help="keep titlecase and id results between runs (uses " + CACHE_NAME + " in the project root)")
+	parser.add_argument("--stats", action="store_true", help="print titlecase and id cache statistics")
+	parser.add_argument("--profile", action="store_true", help="time each stage of processing and print a report")
+	parser.add_argument("--profile-format", choices=["table", "json"], default="table", help="format of the --profile report (default table)")
+	parser.add_argument("--divisions", metavar="FILE", help="JSON file of extra epub:type tokens that mark divisions, eg {\"canto\": {\"division\": \"chapter\", \"prefix\": \"Canto\"}}")
+	parser.add_argument("--from-file", metavar="FILE", help="also process the directories listed in FILE, one per line (- for standard input)")
+	parser.add_argument("--watch", action="store_true", help="after processing, keep watching the project and reprocess files as they change (uses inotify_simple if installed, otherwise polls)")
+	parser.add_argument("--watch-interval", type=float, default=1.0, metavar="SECONDS", help="how often --watch polls for changes (default 1)")
+	parser.add_argument("directories", metavar="DIRECTORY", nargs="*", help="a Standard Ebooks source directory")
+	args = parser.parse_args()
+
+	directories = list(args.directories)
+	if args.from_file:
+		directories.extend(read_directory_list(args.from_file))
+	if not directories:
+		parser.error("no Standard Ebooks directory given")
+	if args.jobs < 1:
+		print("Error: --jobs must be at least 1")
+		exit(-1)
+	if args.memory_budget is not None and args.memory_budget < 1:
+		print("Error: --memory-budget must be at least 1")
+		exit(-1)
+	if args.divisions:
+		divisions = load_divisions(args.divisions)
+		if divisions is None:
+			exit(-1)
+		extend_division_table(divisions)
+	if args.check and args.watch:
+		print("Error: --check can't be used with --watch")
+		exit(-1)
+	if args.watch and len(directories) > 1:
+		print("Error: --watch only works with a single directory")
+		exit(-1)
+
+	emitter = RecordEmitter(args.emit, sys.stdout) if args.emit else None
+	# with --emit, standard output is kept for the records
+	with contextlib.redirect_stdout(sys.stderr) if emitter else contextlib.nullcontext():
+		status = run(args, directories, emitter)
+	if emitter:
+		emitter.close()
+	if status:
+		exit(status)
+
+
+def run(args, directories: list, emitter: RecordEmitter = None) -> int:
+	"""
+	Process (or watch) the projects asked for on the command line.
+
+	INPUTS:
+	args: parsed command-line arguments
+	directories: Standard Ebooks root directories
+	emitter: if given, title records for --emit are passed to it
+
+	OUTPUTS:
+	exit status: 0 if all went well
+	"""
+	global PROFILER
+	if args.profile:
+		PROFILER = Profiler()
+	run_start = time.perf_counter()
+
+	if args.cache:
+		# load every project's cache up front, so they all share one warm cache
+		for rootpath in directories:
+			load_caches(rootpath)
+
+	if args.memory_budget:
+		args.jobs = jobs_within_budget(args.jobs, args.memory_budget * MIB, directories, args.fast or args.check)
+
+	# one pool serves every project, so worker start-up and imports are only paid once
+	pool = start_pool(args.jobs) if args.jobs > 1 else None
+	summaries = {}
+	try:
+		if args.watch:
+			watch_project(directories[0], args, pool, emitter)
+			return -1  # only returns if the directory is not (or is no longer) a project
+		for rootpath in directories:
+			label = rootpath + ": " if len(directories) > 1 else ""
+			summaries[rootpath] = process_project(rootpath, args, pool, label, emitter=emitter)
+			if args.check and args.fail_fast and summaries[rootpath] and summaries[rootpath]["failures"]:
+				break
+	except KeyboardInterrupt:
+		if not args.watch:
+			raise
+		if pool:
+			pool.terminate()
+	finally:
+		if pool:
+			pool.close()
+			pool.join()
 
+	if len(directories) > 1:
+		failed = [rootpath for rootpath, summary in summaries.items() if summary is None or summary.get("failed")]
+		# eg --fail-fast stops before the later projects
+		not_run = [rootpath for rootpath in directories if rootpath not in summaries]
+		totals = collections.Counter()
+		for summary in summaries.values():
+			totals.update({key: value for key, value in (summary or {}).items() if isinstance(value, int)})
+		print("Projects: " + str(len(summaries) - len(failed)) + " processed, " + str(len(failed)) + " failed" + (", " + str(len(not_run)) + " not run" if not_run else "") + "; files processed: " + str(totals["processed"]) + " of " + str(totals["spine"]) + ", written: " + str(totals["written"]))
+		if not_run:
+			print("Not run: " + ", ".join(not_run))
+	if args.stats:
+		for name, cache in CACHES.items():
+			print(name + " cache: " + cache.stats())
+	if PROFILER:
+		print(PROFILER.report(args.profile_format))
+		print("Total run time: {:.1f} ms".format((time.perf_counter() - run_start) * 1000))
+	if any(summary is None or summary.get("failed") for summary in summaries.values()):
+		return -1
+	if args.dry_run and any(summary.get("would_change") for summary in summaries.values()):
+		return 1
+	if args.check and any(summary["failures"] for summary in summaries.values()):
+		return 1
+	return 0
 
 if __name__ == "__main__":
 	main()
\ No newline at end of file